@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+"""OS classification of records, previous per-family regexes vs the cached classifier.
+
+  benchmarks/os_classifier.py -r 1000000
+"""
+import os, sys, argparse, time, random, re
+
+DN = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(DN + '/../src')
+import cloudinventario.platform as platform
+
+OS_NAMES = [
+  ("Ubuntu Linux (64-bit)", None), ("Ubuntu 20.04", None), ("Debian GNU/Linux 10 (64-bit)", None),
+  ("CentOS 7 (64-bit)", None), ("Red Hat Enterprise Linux 8 (64-bit)", None),
+  ("Other 3.x or later Linux (64-bit)", "RouterOS CHR"), ("Other Linux (64-bit)", None),
+  ("Microsoft Windows Server 2019 (64-bit)", None), ("Windows", None), ("windows", None),
+  ("VMware Photon OS (64-bit)", None), ("Cisco IOS", None), ("FreeBSD 12 (64-bit)", None),
+  ("Amazon Linux 2", None), ("linux", None), ("Container-Optimized OS", None)
+]
+
+# implementation before the classifier
+re_linux = re.compile(".*Linux|Ubuntu|Debian|CentOS|RedHat|Alpine|Gentoo|ROCK", re.IGNORECASE)
+re_routeros = re.compile(".*RouterOS", re.IGNORECASE)
+re_windows = re.compile(".*Windows", re.IGNORECASE)
+re_vmware = re.compile(".*VMware", re.IGNORECASE)
+re_cisco = re.compile(".*Cisco", re.IGNORECASE)
+
+def legacy_os_family(str, desc = None):
+  if re_linux.match(str):
+    if desc and re_routeros.match(desc):
+      return "RouterOS"
+    return "Linux"
+  elif re_windows.match(str):
+    return "Windows"
+  elif re_routeros.match(str):
+    return "RouterOS"
+  elif re_vmware.match(str):
+    return "VMware"
+  elif re_cisco.match(str):
+    return "Cisco"
+  else:
+    return "Other"
+
+def legacy_os(str, desc = None):
+  if re_linux.match(str) and desc and re_routeros.match(desc):
+      return "RouterOS/Linux"
+  return str
+
+def getArgs():
+  parser = argparse.ArgumentParser(description='OS classifier benchmark')
+  parser.add_argument('-r', '--records', action='store', type=int, default=1000000,
+                        help='number of records')
+  return parser.parse_args()
+
+def run(records, os_family, get_os):
+  start = time.perf_counter()
+  for name, desc in records:
+    os_family(name, desc)
+    get_os(name, desc)
+  return time.perf_counter() - start
+
+def main(args):
+  random.seed(1)
+  records = [random.choice(OS_NAMES) for idx in range(args.records)]
+
+  for name, desc in OS_NAMES:
+    assert legacy_os_family(name, desc) == platform.get_os_family(name, desc), name
+    assert legacy_os(name, desc) == platform.get_os(name, desc), name
+
+  for label, os_family, get_os in [("regexes", legacy_os_family, legacy_os),
+                                   ("classifier", platform.get_os_family, platform.get_os)]:
+    runtime = run(records, os_family, get_os)
+    print("{:<10} {:>9} records {:>8.3f}s {:>11.0f} records/s".format(label, args.records, runtime, args.records / runtime))
+  return 0
+
+if __name__ == "__main__":
+  sys.exit(main(getArgs()))
@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+"""Memory per inventory record, plain dict vs InventoryRecord.
+
+  benchmarks/record_memory.py -r 100000
+"""
+import os, sys, argparse, gc, tracemalloc
+
+DN = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(DN + '/../src')
+from cloudinventario.helpers import CloudCollector
+
+def getArgs():
+  parser = argparse.ArgumentParser(description='Record memory benchmark')
+  parser.add_argument('-r', '--records', action='store', type=int, default=100000,
+                        help='number of records')
+  return parser.parse_args()
+
+def record(collector, i):
+  return collector.new_record("vm", {
+      "name": "vm-{:07d}".format(i),
+      "id": "id-{:07d}".format(i),
+      "project": "project-{}".format(i % 64),
+      "location": "dc-{}".format(i % 4),
+      "cpus": 1 + i % 16,
+      "memory": 1024 * (1 + i % 32),
+      "disks": 1 + i % 4,
+      "primary_ip": "10.{}.{}.{}".format(i >> 16 & 255, i >> 8 & 255, i & 255),
+      "os": "Ubuntu 20.04",
+      "is_on": True,
+      "owner": "owner-{}".format(i % 100),
+      "tags": {"env": "prod"},
+      "networks": [{"ip": "10.0.0.1", "mac": "00:00:00:00:00:01"}],
+      "storages": [{"id": "disk-0", "capacity": 10240}],
+    }, {"raw": i})
+
+def measure(count, build):
+  gc.collect()
+  tracemalloc.start()
+  start = tracemalloc.get_traced_memory()[0]
+  data = [build(i) for i in range(count)]
+  size = tracemalloc.get_traced_memory()[0] - start
+  tracemalloc.stop()
+  del data
+  return size / count
+
+def main(args):
+  collector = CloudCollector("bench", {}, {}, {})
+
+  results = [
+    ("dict", measure(args.records, lambda i: dict(record(collector, i)))),
+    ("InventoryRecord", measure(args.records, lambda i: record(collector, i)))
+  ]
+  for name, size in results:
+    print("{:<16} {:>9} records {:>8.0f} bytes/record".format(name, args.records, size))
+  return 0
+
+if __name__ == "__main__":
+  sys.exit(main(getArgs()))
@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+"""Serializer backends on details payloads shaped like AWS EC2 and vSphere VM records.
+
+  benchmarks/serializer.py -n 20000
+"""
+import os, sys, argparse, time, datetime, decimal, json
+
+DN = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(DN + '/../src')
+from cloudinventario.serializer import BACKENDS, get_serializer, orjson
+
+def getArgs():
+  parser = argparse.ArgumentParser(description='Serializer benchmark')
+  parser.add_argument('-n', '--count', action='store', type=int, default=20000,
+                        help='payloads per backend')
+  return parser.parse_args()
+
+def aws_instance(i):
+  # describe_instances Reservations[].Instances[] item (boto3 returns datetimes)
+  launched = datetime.datetime(2021, 3, 1, 10, 0, tzinfo = datetime.timezone.utc) + datetime.timedelta(minutes = i)
+  return {
+    "AmiLaunchIndex": 0, "ImageId": "ami-0abcdef1234567890", "InstanceId": "i-{:017x}".format(i),
+    "InstanceType": "m5.large", "KeyName": "deploy", "LaunchTime": launched,
+    "Monitoring": {"State": "disabled"},
+    "Placement": {"AvailabilityZone": "eu-central-1a", "GroupName": "", "Tenancy": "default"},
+    "PrivateDnsName": "ip-10-0-1-{}.eu-central-1.compute.internal".format(i % 250),
+    "PrivateIpAddress": "10.0.1.{}".format(i % 250), "ProductCodes": [],
+    "State": {"Code": 16, "Name": "running"}, "SubnetId": "subnet-0123456789abcdef0",
+    "VpcId": "vpc-0123456789abcdef0", "Architecture": "x86_64",
+    "BlockDeviceMappings": [{"DeviceName": "/dev/xvda", "Ebs": {"AttachTime": launched,
+      "DeleteOnTermination": True, "Status": "attached", "VolumeId": "vol-{:017x}".format(i)}}],
+    "EbsOptimized": False, "EnaSupport": True, "Hypervisor": "xen",
+    "NetworkInterfaces": [{
+      "Attachment": {"AttachTime": launched, "AttachmentId": "eni-attach-{:x}".format(i),
+                     "DeleteOnTermination": True, "DeviceIndex": 0, "Status": "attached"},
+      "Description": "", "Groups": [{"GroupName": "default", "GroupId": "sg-0123456789abcdef0"}],
+      "Ipv6Addresses": [], "MacAddress": "02:00:00:00:{:02x}:{:02x}".format(i >> 8 & 255, i & 255),
+      "NetworkInterfaceId": "eni-{:017x}".format(i), "OwnerId": "123456789012",
+      "PrivateIpAddresses": [{"Primary": True, "PrivateIpAddress": "10.0.1.{}".format(i % 250)}],
+      "SourceDestCheck": True, "Status": "in-use", "SubnetId": "subnet-0123456789abcdef0"}],
+    "RootDeviceName": "/dev/xvda", "RootDeviceType": "ebs",
+    "SecurityGroups": [{"GroupName": "default", "GroupId": "sg-0123456789abcdef0"}],
+    "Tags": [{"Key": "Name", "Value": "web-{}".format(i)}, {"Key": "env", "Value": "prod"}],
+    "VirtualizationType": "hvm", "CpuOptions": {"CoreCount": 1, "ThreadsPerCore": 2},
+    "CapacityReservationSpecification": {"CapacityReservationPreference": "open"},
+    "HibernationOptions": {"Configured": False}, "MetadataOptions": {"State": "applied",
+      "HttpTokens": "optional", "HttpPutResponseHopLimit": 1, "HttpEndpoint": "enabled"}
+  }
+
+def vsphere_vm(i):
+  # summary/config/guest properties flattened the way the vSphere collector stores them
+  booted = datetime.datetime(2022, 6, 1, 8, 30) + datetime.timedelta(hours = i)
+  return {
+    "name": "vm-{:05d}".format(i), "uuid": "4215{:028x}".format(i), "instanceUuid": "5015{:028x}".format(i),
+    "guestFullName": "Ubuntu Linux (64-bit)", "guestId": "ubuntu64Guest", "version": "vmx-14",
+    "numCpu": 4, "numCoresPerSocket": 2, "memorySizeMB": 8192, "bootTime": booted,
+    "overallStatus": "green", "powerState": "poweredOn", "connectionState": "connected",
+    "committed": 85899345920 + i, "uncommitted": 1073741824, "unshared": 85899345920,
+    "cpuReservation": 0, "memoryReservation": 0, "cpuUsage": decimal.Decimal("412.5"),
+    "annotation": "managed by terraform\nowner: team-{}".format(i % 10),
+    "disks": [{"label": "Hard disk {}".format(d + 1), "capacityInKB": 41943040, "thinProvisioned": True,
+               "fileName": "[ds-{}] vm-{:05d}/vm-{:05d}_{}.vmdk".format(d, i, i, d)} for d in range(3)],
+    "nics": [{"label": "Network adapter 1", "macAddress": "00:50:56:{:02x}:{:02x}:01".format(i >> 8 & 255, i & 255),
+              "network": "VLAN-{}".format(100 + i % 20), "connected": True,
+              "ipAddress": ["10.1.{}.{}".format(i >> 8 & 255, i & 255), "fe80::250:56ff:fe00:1"]}],
+    "customValue": {1: "backup", 2: "gold"},
+    "extraConfig": {"tools.guest.desktop.autolock": "FALSE", "svga.present": "TRUE", "pciBridge0.present": "TRUE"}
+  }
+
+def run(serializer, payloads):
+  start = time.perf_counter()
+  size = 0
+  for payload in payloads:
+    size += len(serializer.dumps(payload))
+  return time.perf_counter() - start, size
+
+def main(args):
+  for label, build in [("aws", aws_instance), ("vsphere", vsphere_vm)]:
+    payloads = [build(i) for i in range(args.count)]
+    for name in BACKENDS.keys():
+      if name == "orjson" and orjson is None:
+        print("{:<8} {:<7} not installed".format(label, name))
+        continue
+      serializer = get_serializer(name)
+      runtime, size = run(serializer, payloads)
+      print("{:<8} {:<7} {:>8} payloads {:>8.3f}s {:>10.0f} payloads/s {:>6.0f} bytes/payload".format(
+              label, name, args.count, runtime, args.count / runtime, size / args.count))
+
+    # outputs decode to the same data
+    decoded = [json.loads(get_serializer(name).dumps(payloads[0])) for name in BACKENDS.keys() if name != "orjson" or orjson]
+    assert all(rec == decoded[0] for rec in decoded), "serializers differ"
+  return 0
+
+if __name__ == "__main__":
+  sys.exit(main(getArgs()))
@@ -1 +1,6 @@
 """Cloudinventory"""
+import os
+
+# collectors change working directory, relative paths (sqlite DSN, spool) are resolved against the startup one
+# (set when the package is first imported, modules using it may be imported later)
+STARTUP_DIR = os.getcwd()
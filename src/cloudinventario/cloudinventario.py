@@ -1,16 +1,44 @@
 """CloudInventario"""
-import os, sys, importlib, re, threading, logging
+import os, sys, threading, logging, contextlib
 from pprint import pprint
 
-from cloudinventario.storage import InventoryStorage
-
-COLLECTOR_PREFIX = 'cloudinventario'
+import cloudinventario.serializer as serializer
+import cloudinventario.platform as platform
+import cloudinventario.registry as registry
+# storage (SQLAlchemy), writer and spool are imported when used, listing collectors does not need them
+
+COLLECTOR_PREFIX = registry.COLLECTOR_PREFIX
+
+# working directory is process wide, concurrent collectors share it
+_workdir_lock = threading.Lock()
+_workdir_users = 0
+_workdir_orig = None
+
+@contextlib.contextmanager
+def _workdir(path):
+   global _workdir_users, _workdir_orig
+
+   with _workdir_lock:
+     if _workdir_users == 0:
+       _workdir_orig = os.getcwd()
+       os.chdir(path)
+     _workdir_users += 1
+   try:
+     yield
+   finally:
+     with _workdir_lock:
+       _workdir_users -= 1
+       if _workdir_users == 0:
+         os.chdir(_workdir_orig)
 
 class CloudInventario:
 
    def __init__(self, config):
      self.config = config
-     self.lock = threading.Lock()
+     if "serializer" in config:
+       serializer.configure(config["serializer"])
+     if "platform" in config:
+       platform.configure(config["platform"].get("rules"))
 
    @property
    def collectors(self):
@@ -36,67 +64,107 @@ class CloudInventario:
      mod_defaults = mod_cfg.get('default', {})
      return CloudInventario.loadCollectorModule(mod_name, collector, mod_config, mod_defaults, options)
 
+   def collectorInfo(self, collector):
+     return registry.get_collector(self.collectorConfig(collector)['module'])
+
    @staticmethod
    def loadCollectorModule(mod_name, collector, config, defaults = None, options = None):
-     mod_name = re.sub(r'[/.]', '_', mod_name) # basic safety, should throw error
-     mod_name = re.sub(r'_', '__', mod_name)
-     mod_name = re.sub(r'-', '_', mod_name)
-     mod_pkg = COLLECTOR_PREFIX + '_' + mod_name
+     info = registry.get_collector(mod_name)
 
-     mod = importlib.import_module(mod_pkg + '.collector')
+     mod = info.load()
      mod_instance = mod.setup(collector, config, defaults, options or {})
 
      # XXX: init for resource collectors (I don't like it)
      mod_instance._init(
-        collector_pkg = mod_pkg,
+        collector_pkg = info.package,
         resources = config.get('collect', [])
      )
      return mod_instance
 
    def collect(self, collector, options = None):
-     # workaround for buggy libs
-     wd = os.getcwd()
-     os.chdir("/tmp")
+     return list(self.iter_collect(collector, options))
 
-     inventory = None
-     try:
-       instance = self.loadCollector(collector, options)
-       instance.login()
-       inventory = instance.fetch()
-       instance.logout()
-     except Exception as e:
-       logging.error("Exception while processing collector={}".format(collector))
-       raise
-     finally:
-       os.chdir(wd)
-     return inventory
+   def iter_collect(self, collector, options = None):
+     """Collect inventory lazily, records are yielded as they are fetched."""
+     # workaround for buggy libs
+     with _workdir("/tmp"):
+       try:
+         instance = self.loadCollector(collector, options)
+         instance.login()
+         yield from instance.iter_fetch()
+         instance.logout()
+       except Exception as e:
+         logging.error("Exception while processing collector={}".format(collector))
+         raise
+
+   def preload(self, collectors = None):
+     """Import collectors with their SDKs (forked workers inherit them instead of importing)."""
+     modules = {}
+     for col in (collectors or self.collectors):
+       info = self.collectorInfo(col)
+       modules.setdefault(info.module, info)
+     for info in modules.values():
+       info.preload()
 
-   def store(self, inventory, runtime = None):
-     store_config = self.config["storage"]
+   @property
+   def storage(self):
+     import cloudinventario.writer as writer
+     from cloudinventario.storage import get_storage
 
-     with self.lock:
-       store = InventoryStorage(store_config)
+     # workers attached to a writer process send their data to it
+     store = writer.attached() or get_storage(self.config["storage"])
+     store.connect()
+     return store
 
-       store.connect()
-       store.save(inventory, runtime)
-       store.disconnect()
+   @property
+   def spool(self):
+     path = self.config["storage"].get("spool_dir")
+     if not path:
+       return None
+     from cloudinventario.spool import Spool
+     return Spool(path)
 
+   def store(self, inventory, runtime = None):
+     spool = self.spool
+     if spool is None or inventory is None:
+       # storage is shared, it serializes the writes itself
+       self.storage.save(inventory, runtime)
+       return True
+
+     # records are spooled while being stored, the spool is kept if storing fails
+     inventory = iter(inventory)
+     spooled = spool.writer()
+     try:
+       self.storage.save(spooled.tee(inventory), runtime)
+     except Exception:
+       if spooled.failed:
+         spooled.discard()
+         raise
+       try:
+         spooled.drain(inventory)
+       except Exception:
+         spooled.discard()
+         raise
+       spooled.finish(runtime() if callable(runtime) else runtime)
+       logging.error("failed to store data, spooled to {} (use --replay-spool)".format(spooled.path))
+       raise
+     spooled.discard()
      return True
 
-   def store_status(self, source, status, runtime = None, error = None):
-     store_config = self.config["storage"]
+   def replay_spool(self):
+     spool = self.spool
+     if spool is None:
+       return 0
+     return spool.replay(self.storage)
 
-     with self.lock:
-       store = InventoryStorage(store_config)
-       store.connect()
-       store.log_status(source, status, runtime, error)
-       store.disconnect()
+   def store_status(self, source, status, runtime = None, error = None):
+     self.storage.log_status(source, status, runtime, error)
      return True
 
-   def cleanup(self, days):
-     store_config = self.config["storage"]
-     store = InventoryStorage(store_config)
+   def cleanup(self, days = None, keep = None):
+     self.storage.cleanup(days, keep)
 
-     store.connect()
-     store.cleanup(days)
-     store.disconnect()
+   def close(self):
+     storage = sys.modules.get("cloudinventario.storage")
+     if storage is not None:
+       storage.close_storages()
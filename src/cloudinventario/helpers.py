@@ -1,19 +1,144 @@
 """Classes used by CloudInventario."""
 import requests
-import datetime
-import json
 import logging
 import importlib
+import queue
+import threading
+import concurrent.futures
+import collections
+import time
 from pprint import pprint
 
 import cloudinventario.platform as platform
+import cloudinventario.serializer as serializer
+from cloudinventario.projection import get_projections
+from cloudinventario.record import InventoryRecord
+
+RESOURCE_QUEUE_SIZE = 1000
+
+def iter_graph(nodes, depends, produce, workers = 1):
+  """Yield items of produce(node) for nodes (in order), a node starts once all its depends finished.
+
+  With workers > 1 independent nodes run in threads and their items are
+  interleaved, dependencies not in nodes are ignored.
+  """
+  pending = { node: set(depends.get(node, [])) & set(nodes) for node in nodes }
+
+  def ready():
+    return [node for node in nodes if node in pending and len(pending[node]) == 0]
+
+  def finished(node):
+    for deps in pending.values():
+      deps.discard(node)
+
+  if workers <= 1:
+    while pending:
+      runnable = ready()
+      if not runnable:
+        raise Exception("Dependency cycle between: {}".format(", ".join(pending.keys())))
+      node = runnable[0]
+      del pending[node]
+      yield from produce(node)
+      finished(node)
+    return
 
-class CloudEncoder(json.JSONEncoder):
-  def default(self, z):
-    if isinstance(z, datetime.datetime):
-      return (str(z))
-    else:
-      return super().default(z)
+  items = queue.Queue(RESOURCE_QUEUE_SIZE)
+  stop = threading.Event()
+  done = object()
+
+  def put(item):
+    # consumer may be gone (error, generator closed)
+    while not stop.is_set():
+      try:
+        items.put(item, timeout = 0.1)
+        return True
+      except queue.Full:
+        pass
+    return False
+
+  def run(node):
+    try:
+      for item in produce(node):
+        if not put((node, item, None)):
+          return
+      put((node, done, None))
+    except Exception as e:
+      put((node, done, e))
+
+  executor = concurrent.futures.ThreadPoolExecutor(max_workers = workers, thread_name_prefix = "resource")
+  try:
+    running = 0
+    while True:
+      for node in ready():
+        del pending[node]
+        executor.submit(run, node)
+        running += 1
+      if running == 0:
+        break
+
+      node, item, error = items.get()
+      if item is done:
+        running -= 1
+        if error:
+          raise error
+        finished(node)
+      else:
+        yield item
+
+    if pending:
+      raise Exception("Dependency cycle between: {}".format(", ".join(pending.keys())))
+  finally:
+    stop.set()
+    executor.shutdown(wait = True)
+
+def bounded_map(executor, func, items, window):
+  """Like executor.map() (results in order), with at most window calls submitted ahead of the consumer."""
+  pending = collections.deque()
+  try:
+    for item in items:
+      if len(pending) >= window:
+        yield pending.popleft().result()
+      pending.append(executor.submit(func, item))
+    while pending:
+      yield pending.popleft().result()
+  finally:
+    for future in pending:
+      future.cancel()
+
+class lazy_import:
+  """Module (or its attribute) imported on first use, collectors keep SDK imports out of startup.
+
+    boto3 = lazy_import("boto3")
+    vim = lazy_import("pyVmomi", "vim")
+  """
+  __slots__ = ("_name", "_attr", "_target", "_lock")
+
+  def __init__(self, name, attr = None):
+    self._name = name
+    self._attr = attr
+    self._target = None
+    self._lock = threading.Lock()
+
+  def _load(self):
+    if self._target is None:
+      with self._lock:
+        if self._target is None:
+          start = time.perf_counter()
+          target = importlib.import_module(self._name)
+          if self._attr is not None:
+            target = getattr(target, self._attr)
+          logging.debug("imported {} in {:.3f}s".format(self, time.perf_counter() - start))
+          self._target = target
+    return self._target
+
+  def __getattr__(self, name):
+    return getattr(self._load(), name)
+
+  def __call__(self, *args, **kwargs):
+    return self._load()(*args, **kwargs)
+
+  def __repr__(self):
+    return self._name + (":" + self._attr if self._attr else "")
 
 class CloudCollector:
   """Cloud collector."""
@@ -32,6 +157,9 @@ class CloudCollector:
     self.resource_manager = None
     self.resource_collectors = {}
 
+    # details kept for each record type (the collector's 'details' config)
+    self.projections = get_projections(config.get("details"))
+
     return
 
   def _init(self, **kwargs):
@@ -72,12 +200,14 @@ class CloudCollector:
     return True
 
   def fetch(self, collect = None):
+    return list(self.iter_fetch(collect))
+
+  def iter_fetch(self, collect = None):
+    """Yield records as they are produced, without building the inventory list."""
     self.__pre_request()
     try:
-      data = []
-      data.extend(self._resource_fetch())
-      data.extend(self._fetch(collect))
-      return data
+      yield from self._resource_fetch()
+      yield from self._fetch(collect)
     except:
       raise
     finally:
@@ -85,17 +215,25 @@ class CloudCollector:
 
   def _resource_fetch(self):
     if not self.resource_manager:
-      return []
+      return
 
-    data = []
-    try:
-      res = ''
-      for res in self.resource_collectors.values(): # self.resource_collectors is already ordered by dependecy
-        data.extend(res.fetch())
-      return data
-    except Exception:
-      logging.error("Failed to fetch the following resource collector: {}".format(res.res_type))
-      raise
+    # all records are streamed, resources needed by the collector or by other resources keep their indexes
+    graph = self.resource_manager.get_graph(self.resource_collectors)
+    needed = set(self.dependencies or [])
+    for deps in graph.values():
+      needed.update(deps)
+
+    def produce(name):
+      res = self.resource_collectors[name]
+      try:
+        yield from res.iter_fetch(keep = name in needed)
+      except Exception:
+        logging.error("Failed to fetch the following resource collector: {}".format(name))
+        raise
+
+    workers = self.config.get("resource_workers", self.options.get("tasks") or 1)
+    # self.resource_collectors is already ordered by dependecy
+    yield from iter_graph(list(self.resource_collectors.keys()), graph, produce, workers)
 
   def logout(self):
     self.__pre_request()
@@ -152,11 +290,11 @@ class CloudCollector:
     attrs = {**self.defaults, **attrs}
 
     attr_json_keys = [ "networks", "storages", "tags"]
-    rec = {
-      "type": rectype,
-      "source": self.name,
-      "attributes": None
-    }
+    rec = InventoryRecord(
+      type = rectype,
+      source = self.name,
+      attributes = None
+    )
 
     for key in attr_keys:
       if not attrs.get(key):
@@ -173,7 +311,7 @@ class CloudCollector:
       if not attrs.get(key):
         rec[key] = '[]'
       else:
-        rec[key] = json.dumps(attrs[key], default=str) # added default=str -> problem with AttachTime,CreateTime
+        rec[key] = serializer.dumps(attrs[key]) # str() for unknown types -> problem with AttachTime,CreateTime
         del(attrs[key])
 
     for key in ["cluster", "status"]: # fields that possibly contain data structures
@@ -182,7 +320,7 @@ class CloudCollector:
         rec[key] = None
       else:
         if type(value) in [dict, list]:
-          rec[key] = json.dumps(value, default=str)
+          rec[key] = serializer.dumps(value)
         else:
           rec[key] = value
 
@@ -193,8 +331,11 @@ class CloudCollector:
       rec["os"] = platform.get_os(rec.get("os"), rec.get("description"))
 
     if len(attrs) > 0:
-      rec["attributes"] = json.dumps(attrs, default=str)
-    rec["details"] = json.dumps(details, cls=CloudEncoder, default=str)
+      rec["attributes"] = serializer.dumps(attrs)
+    projection = self.projections.get(rectype) or self.projections.get("*")
+    if projection:
+      details = projection.apply(details)
+    rec["details"] = serializer.dumps(details)
 
     return rec
 
@@ -204,27 +345,19 @@ class CloudInvetarioResourceManager:
     self.res_list = res_list or []
     self.collector_pkg = collector_pkg
     self.collector = collector
-    self.dep_classif = {  # dependency_classification
-      "dependency": set(),
-      "not_dependency": set(),
-    }
 
   def get_resource_objs(self, res_dep_list = []):
     obj_dict = {}
+    res_dep_list = res_dep_list or []
 
-    # sorting based on whether a resource needs priority in fetching or not
-    res_list = list(set((res_dep_list or []) + self.res_list))
-    for resource in res_list:
-      if resource in res_dep_list:
-        self.dep_classif["dependency"].add(resource)
-      else:
-        self.dep_classif["not_dependency"].add(resource)
-
-    res_list = []
-    res_list.extend(self.dep_classif["dependency"] or [])
-    res_list.extend(self.dep_classif["not_dependency"] or [])
+    # resources the collector depends on first, then the configured ones (in order, without duplicates)
+    res_list = list(dict.fromkeys(res_dep_list + self.res_list))
 
-    for res in res_list:
+    # resources required by other resources are loaded too
+    idx = 0
+    while idx < len(res_list):
+      res = res_list[idx]
+      idx += 1
       try:
         mod_name = self.collector_pkg + ".resources." + res
         logging.debug("Importing module: {}".format(mod_name))
@@ -233,10 +366,43 @@ class CloudInvetarioResourceManager:
         logging.error("Failed to load the following module:{}, reason: {}".format(mod_name, e))
         continue
       obj_dict[res] = res_mod.setup(res, self.collector)
-
-    return obj_dict
+      for dep in obj_dict[res].get_dependencies():
+        if dep not in res_list:
+          res_list.append(dep)
+
+    # dependencies first, keeping the original order otherwise
+    return { res: obj_dict[res] for res in self.__sort(obj_dict) }
+
+  def get_graph(self, res_objs):
+    """Dependency graph, resource -> resources it depends on."""
+    return { res: [dep for dep in obj.get_dependencies() if dep in res_objs] for res, obj in res_objs.items() }
+
+  def __sort(self, res_objs):
+    graph = self.get_graph(res_objs)
+    order = []
+    visiting = set()
+
+    def visit(res):
+      if res in order:
+        return
+      if res in visiting:
+        raise Exception("Resource dependency cycle at: {}".format(res))
+      visiting.add(res)
+      for dep in graph[res]:
+        visit(dep)
+      visiting.discard(res)
+      order.append(res)
+
+    for res in res_objs.keys():
+      visit(res)
+    return order
 
 class CloudInvetarioResource():
+  # resources (of the same collector) that must be fetched before this one
+  DEPENDS = []
+
+  # indexes of the fetched data, name -> function returning the keys of a record (attrs)
+  INDEXES = {}
 
   def __init__(self, res_type, collector):
     self.res_type = res_type
@@ -245,6 +411,10 @@ class CloudInvetarioResource():
     self.client = None
     self.data = None
     self.raw_data = []
+    self.indexes = { name: {} for name in self.INDEXES.keys() }
+
+  def get_dependencies(self):
+    return list(self.DEPENDS) + self.collector.config.get("resource_depends", {}).get(self.res_type, [])
 
   def login(self, session):
     try:
@@ -256,12 +426,29 @@ class CloudInvetarioResource():
     try:
       logging.debug("fetching resource={}".format(self.res_type))
       self.raw_data = []
-      self.data = self._fetch()
+      self.indexes = { name: {} for name in self.INDEXES.keys() }
+      self.data = list(self._fetch())
       return self.data
     except Exception:
       logging.error("Failed to fetch the data of the following type of cloud resource: {}". format(self.res_type))
       raise
 
+  def iter_fetch(self, keep = False):
+    """Yield records without keeping them around.
+
+    With keep the data used by other resources or the collector are kept: the
+    indexes (lookup()), or the raw data of resources without indexes.
+    """
+    try:
+      logging.debug("streaming resource={}".format(self.res_type))
+      self.data = None
+      self.raw_data = [] if keep and not self.INDEXES else None
+      self.indexes = { name: {} for name in self.INDEXES.keys() } if keep else None
+      yield from self._fetch()
+    except Exception:
+      logging.error("Failed to fetch the data of the following type of cloud resource: {}". format(self.res_type))
+      raise
+
   def process_resource(self, resource_data):
     try:
       #logging.debug("processing resource={}".format(self.res_type))
@@ -295,6 +482,21 @@ class CloudInvetarioResource():
     except Exception:
       logging.error("Failed to get the raw data of the following of resource: {}".format(self.res_type))
 
+  def get_index(self, name):
+    """Index of the fetched data {key: [attrs]}, built while fetching."""
+    if self.indexes is None:
+      raise Exception("Resource {} was streamed, it has no index".format(self.res_type))
+    return self.indexes[name]
+
+  def lookup(self, name, key):
+    """Records (attrs) with the key in the index."""
+    return self.get_index(name).get(key, [])
+
   def new_record(self, rectype, attrs, details):
-    self.raw_data.append(attrs)
+    if self.raw_data is not None:
+      self.raw_data.append(attrs)
+    if self.indexes is not None:
+      for name, keys in self.INDEXES.items():
+        for key in keys(attrs) or []:
+          self.indexes[name].setdefault(key, []).append(attrs)
     return self.collector.new_record(rectype, attrs, details)
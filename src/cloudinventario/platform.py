@@ -1,34 +1,54 @@
-import re
+import re, functools
 
-re_linux = re.compile(".*Linux|Ubuntu|Debian|CentOS|RedHat|Alpine|Gentoo|ROCK", re.IGNORECASE)
 OS_LINUX = "Linux"
-re_routeros = re.compile(".*RouterOS", re.IGNORECASE)
 OS_ROUTEROS = "RouterOS"
-re_windows = re.compile(".*Windows", re.IGNORECASE)
 OS_WINDOWS = "Windows"
-re_vmware = re.compile(".*VMware", re.IGNORECASE)
 OS_VMWARE = "VMware"
-re_cisco = re.compile(".*Cisco", re.IGNORECASE)
 OS_CISCO = "Cisco"
 OS_OTHER = "Other"
 
+# (family, pattern) matched from the start of the OS string, first match wins
+RULES = [
+  (OS_LINUX, ".*Linux|Ubuntu|Debian|CentOS|RedHat|Alpine|Gentoo|ROCK"),
+  (OS_WINDOWS, ".*Windows"),
+  (OS_ROUTEROS, ".*RouterOS"),
+  (OS_VMWARE, ".*VMware"),
+  (OS_CISCO, ".*Cisco")
+]
+
+re_routeros = re.compile(".*RouterOS", re.IGNORECASE)
+
+CACHE_SIZE = 4096
+
+def _compile(rules):
+  # one alternation, the named group of the first matching rule tells the family
+  pattern = "|".join(["(?P<r{}>{})".format(idx, rule) for idx, (family, rule) in enumerate(rules)])
+  families = { "r{}".format(idx): family for idx, (family, rule) in enumerate(rules) }
+  return re.compile(pattern, re.IGNORECASE), families
+
+re_family, _families = _compile(RULES)
+
+def configure(rules = None):
+  """Add rules ([{family, pattern}], checked before the built-in ones)."""
+  global re_family, _families
+  rules = [(rule["family"], rule["pattern"]) for rule in (rules or [])]
+  re_family, _families = _compile(rules + RULES)
+  classify.cache_clear()
+
+@functools.lru_cache(maxsize = CACHE_SIZE)
+def classify(os, desc = None):
+  """Return (os family, os name)."""
+  m = re_family.match(os)
+  if m is None:
+    return OS_OTHER, os
+
+  family = _families[m.lastgroup]
+  if family == OS_LINUX and desc and re_routeros.match(desc):
+    return OS_ROUTEROS, "RouterOS/Linux"
+  return family, os
+
 def get_os_family(str, desc = None):
-  if re_linux.match(str):
-    if desc and re_routeros.match(desc):
-      return OS_ROUTEROS
-    return OS_LINUX
-  elif re_windows.match(str):
-    return OS_WINDOWS
-  elif re_routeros.match(str):
-    return OS_ROUTEROS
-  elif re_vmware.match(str):
-    return OS_VMWARE
-  elif re_cisco.match(str):
-    return OS_CISCO
-  else:
-    return OS_OTHER
+  return classify(str, desc)[0]
 
 def get_os(str, desc = None):
-  if re_linux.match(str) and desc and re_routeros.match(desc):
-      return "RouterOS/Linux"
-  return str
+  return classify(str, desc)[1]
@@ -0,0 +1,129 @@
+"""Projection of details (include/exclude paths) applied before serialization."""
+import fnmatch
+
+class _Node:
+  __slots__ = ("end", "children")
+
+  def __init__(self):
+    self.end = False
+    self.children = {}
+
+  def add(self, path):
+    node = self
+    for segment in path.split("."):
+      node = node.children.setdefault(segment, _Node())
+    node.end = True
+
+  def match(self, key):
+    """Node of the paths matching key (None if there is none)."""
+    key = str(key)
+    matched = [child for segment, child in self.children.items()
+                 if segment == key or fnmatch.fnmatchcase(key, segment)]
+    if len(matched) == 0:
+      return None
+
+    # more patterns match the key, continue with all of them
+    node = matched[0]
+    for child in matched[1:]:
+      node = _merge(node, child)
+    return node
+
+def _items(node):
+  # lists are transparent, "*" may stand for their items (consumed here, not matched against keys of the items)
+  star = node.children.get("*")
+  if star is None:
+    return node
+  items = _Node()
+  items.end = node.end
+  items.children = { segment: child for segment, child in node.children.items() if segment != "*" }
+  return _merge(items, star)
+
+def _merge(left, right):
+  node = _Node()
+  node.end = left.end or right.end
+  node.children = dict(left.children)
+  for segment, child in right.children.items():
+    node.children[segment] = _merge(node.children[segment], child) if segment in node.children else child
+  return node
+
+_MISSING = object()
+
+class Projection:
+  """Keeps included paths of a structure (all if none), then drops excluded ones.
+
+  Paths are dot separated dict keys with shell wildcards (i.e. "Tag*"), lists
+  are traversed transparently or by "*" (i.e. "disks.*.licenses" == "disks.licenses").
+  The input is not modified.
+  """
+
+  def __init__(self, include = None, exclude = None):
+    self.include = self.__compile(include)
+    self.exclude = self.__compile(exclude)
+
+  def __compile(self, paths):
+    if not paths:
+      return None
+    root = _Node()
+    for path in paths:
+      root.add(path)
+    return root
+
+  def apply(self, obj):
+    if self.include is not None:
+      obj = self.__include(obj, self.include)
+      if obj is _MISSING:
+        obj = {}
+    if self.exclude is not None:
+      obj = self.__exclude(obj, self.exclude)
+    return obj
+
+  def __include(self, obj, node):
+    if node.end:
+      return obj
+    if isinstance(obj, dict):
+      result = {}
+      for key, value in obj.items():
+        child = node.match(key)
+        if child is not None:
+          value = self.__include(value, child)
+          if value is not _MISSING:
+            result[key] = value
+      return result if result else _MISSING
+    if isinstance(obj, (list, tuple)):
+      node = _items(node)
+      result = [value for value in (self.__include(item, node) for item in obj) if value is not _MISSING]
+      return result if result else _MISSING
+    return _MISSING
+
+  def __exclude(self, obj, node):
+    if isinstance(obj, dict):
+      result = {}
+      for key, value in obj.items():
+        child = node.match(key)
+        if child is None:
+          result[key] = value
+        elif not child.end:
+          result[key] = self.__exclude(value, child)
+      return result
+    if isinstance(obj, (list, tuple)):
+      node = _items(node)
+      # "*" excludes the items themselves
+      if node.end:
+        return []
+      return [self.__exclude(item, node) for item in obj]
+    return obj
+
+def get_projections(config):
+  """Projections by record type ("*" for all) from the collector 'details' config."""
+  if not config:
+    return {}
+
+  projections = {}
+  include = config.get("include") or []
+  exclude = config.get("exclude") or []
+  if include or exclude:
+    projections["*"] = Projection(include, exclude)
+  for rectype, type_config in (config.get("types") or {}).items():
+    projections[rectype] = Projection(include + (type_config.get("include") or []),
+                                      exclude + (type_config.get("exclude") or []))
+  return projections
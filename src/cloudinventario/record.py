@@ -0,0 +1,58 @@
+"""Inventory record."""
+import collections.abc
+
+# ci_inventory data columns
+FIELDS = ("source", "type", "name", "cluster", "project", "location", "id", "created",
+          "cpus", "memory", "disks", "storage", "primary_ip", "os", "os_family",
+          "status", "is_on", "owner", "tags", "networks", "storages",
+          "description", "attributes", "details")
+
+# set by the storage
+STORAGE_FIELDS = ("version", "version_last", "hash", "details_hash")
+
+class InventoryRecord(collections.abc.MutableMapping):
+  """Fixed layout record (no per-record dict), used as a mapping of the ci_inventory columns.
+
+  Unset fields are missing from the mapping, unknown ones raise KeyError.
+  """
+  __slots__ = FIELDS + STORAGE_FIELDS
+
+  _keys = frozenset(FIELDS + STORAGE_FIELDS)
+
+  def __init__(self, *args, **kwargs):
+    self.update(*args, **kwargs)
+
+  def __getitem__(self, key):
+    if key not in self._keys:
+      raise KeyError(key)
+    try:
+      return getattr(self, key)
+    except AttributeError:
+      raise KeyError(key) from None
+
+  def __setitem__(self, key, value):
+    if key not in self._keys:
+      raise KeyError("Unknown record field '{}'".format(key))
+    setattr(self, key, value)
+
+  def __delitem__(self, key):
+    if key not in self._keys:
+      raise KeyError(key)
+    try:
+      delattr(self, key)
+    except AttributeError:
+      raise KeyError(key) from None
+
+  def __contains__(self, key):
+    return key in self._keys and hasattr(self, key)
+
+  def __iter__(self):
+    for key in self.__slots__:
+      if hasattr(self, key):
+        yield key
+
+  def __len__(self):
+    return sum(1 for key in self)
+
+  def __repr__(self):
+    return "InventoryRecord({})".format(dict(self))
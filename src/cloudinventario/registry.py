@@ -0,0 +1,102 @@
+"""Registry of collector modules, their metadata is known without importing them (or their SDKs)."""
+import re, time, logging, importlib
+
+COLLECTOR_PREFIX = 'cloudinventario'
+
+# third party collectors: entry point name is the module, its value the collector package
+ENTRY_POINT_GROUP = 'cloudinventario.collectors'
+
+class CollectorInfo:
+  """Collector module (config 'module' value) and the package implementing it."""
+
+  def __init__(self, module, package, resources = None, sdk = None, description = None):
+    self.module = module
+    self.package = package
+    self.resources = list(resources or [])
+    self.sdk = list(sdk or [])
+    self.description = description
+
+  def load(self):
+    """Import the collector module (SDKs are imported by the collector on login)."""
+    start = time.perf_counter()
+    mod = importlib.import_module(self.package + '.collector')
+    logging.info("imported collector module={} in {:.3f}s".format(self.module, time.perf_counter() - start))
+    return mod
+
+  def preload(self):
+    """Import the collector with its SDKs (i.e. once before forking workers)."""
+    self.load()
+    for name in self.sdk:
+      start = time.perf_counter()
+      try:
+        importlib.import_module(name)
+      except ImportError as e:
+        logging.warning("failed to preload module={}, reason: {}".format(name, e))
+        continue
+      logging.info("imported module={} in {:.3f}s".format(name, time.perf_counter() - start))
+
+  def __repr__(self):
+    return "CollectorInfo({}, {})".format(self.module, self.package)
+
+COLLECTORS = {}
+
+def register(module, package, resources = None, sdk = None, description = None):
+  COLLECTORS[module] = CollectorInfo(module, package, resources, sdk, description)
+  return COLLECTORS[module]
+
+register('amazon-aws', 'cloudinventario_amazon_aws', ['ebs', 'elb', 'rds', 's3'],
+         ['boto3'], 'Amazon Web Services - AWS')
+register('amazon-aws-multi', 'cloudinventario_amazon_aws_multi', [],
+         ['boto3'], 'Amazon Web Services - AWS - Multi Role/Region')
+register('amazon-lightsail', 'cloudinventario_amazon_lightsail', ['db', 'disk', 'lb'],
+         ['boto3'], 'Amazon Lightsail')
+register('google-gcp', 'cloudinventario_google_gcp', ['cloud_sql', 'gclb', 'storage'],
+         ['google.oauth2.service_account', 'googleapiclient.discovery'], 'Google Cloud Platform - GCP')
+register('hetzner-hcloud', 'cloudinventario_hetzner_hcloud', ['lb', 'volumes'],
+         ['hcloud'], 'Hetzner Cloud')
+register('libcloud', 'cloudinventario_libcloud', [],
+         ['libcloud.compute.providers'], 'Apache Libcloud')
+register('microsoft-azure', 'cloudinventario_microsoft_azure', [],
+         ['azure.identity', 'azure.mgmt.compute', 'azure.mgmt.resource', 'azure.mgmt.network'], 'Microsoft Azure')
+register('vmware-vcd', 'cloudinventario_vmware_vcd', [],
+         ['pyvcloud.vcd.client'], 'VMWare vCloud Director')
+register('vmware-vsphere', 'cloudinventario_vmware_vsphere', [],
+         ['pyVim.connect', 'pyVmomi'], 'VMWare VSphere')
+
+_entry_points_loaded = False
+
+def _load_entry_points():
+  global _entry_points_loaded
+
+  if _entry_points_loaded:
+    return
+  _entry_points_loaded = True
+  try:
+    from importlib.metadata import entry_points
+  except ImportError:
+    return
+
+  eps = entry_points()
+  eps = eps.select(group = ENTRY_POINT_GROUP) if hasattr(eps, "select") else eps.get(ENTRY_POINT_GROUP, [])
+  for ep in eps:
+    # the package is not imported until the collector is used
+    if ep.name not in COLLECTORS:
+      register(ep.name, ep.value.split(':')[0])
+
+def package_name(module):
+  """Package of a module not in the registry (module path mangled to the package name)."""
+  module = re.sub(r'[/.]', '_', module) # basic safety, should throw error
+  module = re.sub(r'_', '__', module)
+  module = re.sub(r'-', '_', module)
+  return COLLECTOR_PREFIX + '_' + module
+
+def get_collector(module):
+  """CollectorInfo of the config 'module' value."""
+  if module in COLLECTORS:
+    return COLLECTORS[module]
+  _load_entry_points()
+  if module in COLLECTORS:
+    return COLLECTORS[module]
+
+  # unregistered, following the package naming
+  return CollectorInfo(module, package_name(module))
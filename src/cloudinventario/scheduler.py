@@ -0,0 +1,116 @@
+"""Collector scheduler."""
+import asyncio
+import concurrent.futures
+import logging
+import threading
+import time
+import traceback
+
+import cloudinventario.storage as storage
+
+WORKERS = 7
+
+class CollectorScheduler:
+  """Runs collectors concurrently on an event loop.
+
+  Collectors are synchronous, each one runs in a worker thread while the loop
+  enforces the global (workers) and per-module (limits) concurrency.
+  """
+
+  def __init__(self, cinv, workers = None, limits = None):
+    sched_config = cinv.config.get("scheduler", {})
+
+    self.cinv = cinv
+    self.workers = workers or sched_config.get("workers", WORKERS)
+    self.limits = limits or sched_config.get("limits", {})
+
+  def run(self, collectors, options = None):
+    return asyncio.run(self._run(collectors, options or {}))
+
+  async def _run(self, collectors, options):
+    self.semaphore = asyncio.Semaphore(self.workers)
+    self.group_semaphores = {}
+    for group, limit in self.limits.items():
+      self.group_semaphores[group] = asyncio.Semaphore(limit)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers = self.workers) as executor:
+      tasks = [self._run_one(name, options, executor) for name in collectors]
+      return await asyncio.gather(*tasks)
+
+  async def _run_one(self, name, options, executor):
+    queued = time.time()
+    group = self.cinv.collectorConfig(name).get("module")
+    group_semaphore = self.group_semaphores.get(name) or self.group_semaphores.get(group)
+
+    loop = asyncio.get_running_loop()
+    if group_semaphore:
+      async with group_semaphore, self.semaphore:
+        wait = time.time() - queued
+        stats = await loop.run_in_executor(executor, self.collect, name, options)
+    else:
+      async with self.semaphore:
+        wait = time.time() - queued
+        stats = await loop.run_in_executor(executor, self.collect, name, options)
+
+    stats["wait"] = wait
+    logging.info("collector finished name={}, status={}, records={}, runtime={:.2f}s, rate={:.1f}/s, wait={:.2f}s".format(
+                   name, stats["status"], stats["records"], stats["runtime"], stats["rate"], wait))
+    return stats
+
+  def collect(self, name, options):
+    thread = threading.current_thread()
+    thread_name = thread.name
+    thread.name = name
+
+    stats = {
+      "name": name,
+      "status": None,
+      "records": 0,
+      "first": None,
+      "runtime": None,
+      "rate": 0
+    }
+
+    runtime_start = time.time()
+
+    def count(inventory):
+      for rec in inventory:
+        if stats["first"] is None:
+          stats["first"] = time.time() - runtime_start
+        stats["records"] += 1
+        yield rec
+
+    logging.info("collector name={}".format(name))
+    try:
+      inventory = self.cinv.iter_collect(name, options)
+
+      # records are stored while being fetched, runtime is taken once all are in
+      logging.info("storing data for name={}".format(name))
+      self.cinv.store(count(inventory), lambda: time.time() - runtime_start)
+      stats["status"] = storage.STATUS_OK
+    except Exception as e:
+      runtime = time.time() - runtime_start
+      trace = traceback.format_exc()
+
+      stats["status"] = storage.STATUS_ERROR
+      logging.error("collector failed with exception", exc_info=e)
+      try:
+        self.cinv.store_status(name, storage.STATUS_ERROR, runtime, trace)
+      except Exception as e:
+        logging.error("failed to store collector status", exc_info=e)
+    finally:
+      stats["runtime"] = time.time() - runtime_start
+      if stats["runtime"] > 0:
+        stats["rate"] = stats["records"] / stats["runtime"]
+      thread.name = thread_name
+    return stats
+
+def format_stats(stats):
+  lines = ["{:<30} {:<6} {:>9} {:>10} {:>10} {:>9} {:>9}".format(
+             "collector", "status", "records", "records/s", "runtime", "first", "wait")]
+  for rec in sorted(stats, key = lambda rec: rec["name"]):
+    lines.append("{:<30} {:<6} {:>9} {:>10.1f} {:>9.2f}s {:>8} {:>8.2f}s".format(
+                   rec["name"], rec["status"], rec["records"], rec["rate"], rec["runtime"],
+                   "-" if rec["first"] is None else "{:.2f}s".format(rec["first"]),
+                   rec["wait"]))
+  return "\n".join(lines)
@@ -0,0 +1,55 @@
+"""JSON serialization of record fields (networks, storages, tags, attributes, details)."""
+import json
+import logging
+
+try:
+  import orjson
+except ImportError:
+  orjson = None
+
+class JsonSerializer:
+  """Standard library json, objects it does not know are stored as str()."""
+  name = "json"
+
+  def dumps(self, obj):
+    return json.dumps(obj, default=str)
+
+class OrjsonSerializer(JsonSerializer):
+  """orjson, compact output, falls back to json for data orjson rejects (i.e. big ints)."""
+  name = "orjson"
+
+  def __init__(self):
+    # datetimes as str() like the json backend, non str keys are converted
+    self.option = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS
+
+  def dumps(self, obj):
+    try:
+      return orjson.dumps(obj, default = str, option = self.option).decode("utf-8")
+    except orjson.JSONEncodeError:
+      return super().dumps(obj)
+
+BACKENDS = {
+  "json": JsonSerializer,
+  "orjson": OrjsonSerializer
+}
+
+def get_serializer(name = None):
+  """Serializer backend by name, default is the fastest one available."""
+  if name is None:
+    name = "orjson" if orjson else "json"
+  if name == "orjson" and orjson is None:
+    logging.warning("orjson not installed, using json serializer")
+    name = "json"
+  if name not in BACKENDS:
+    raise Exception("Unknown serializer '{}'".format(name))
+  return BACKENDS[name]()
+
+_serializer = get_serializer()
+
+def configure(name = None):
+  global _serializer
+  _serializer = get_serializer(name)
+  return _serializer
+
+def dumps(obj):
+  return _serializer.dumps(obj)
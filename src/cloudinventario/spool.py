@@ -0,0 +1,105 @@
+"""On-disk record spool (NDJSON), keeps collected data when storing it fails."""
+import os, json, glob, time, logging, itertools, threading
+
+from cloudinventario import STARTUP_DIR
+
+SPOOL_SUFFIX = ".ndjson"
+PART_SUFFIX = ".part"
+
+_counter = itertools.count()
+
+class Spool:
+   """Directory of spool files, one per stored inventory.
+
+   Records are appended while being fetched (.part), a complete file ends with
+   a trailer line and is removed once the data are in the storage.
+   """
+
+   def __init__(self, path):
+     # collectors change working directory
+     self.path = os.path.join(STARTUP_DIR, path)
+     os.makedirs(self.path, exist_ok = True)
+
+   def writer(self):
+     name = "{}-{}-{}-{}".format(time.strftime("%Y%m%d%H%M%S"), os.getpid(),
+                                 threading.get_ident(), next(_counter))
+     return SpoolWriter(os.path.join(self.path, name + SPOOL_SUFFIX))
+
+   def files(self):
+     """Complete spool files, oldest first."""
+     parts = glob.glob(os.path.join(self.path, "*" + SPOOL_SUFFIX + PART_SUFFIX))
+     if parts:
+       logging.warning("spool: ignoring {} incomplete file(s) in {}".format(len(parts), self.path))
+     return sorted(glob.glob(os.path.join(self.path, "*" + SPOOL_SUFFIX)))
+
+   def replay(self, storage):
+     """Import complete spool files into the storage, return number of imported files."""
+     count = 0
+     for path in self.files():
+       reader = SpoolReader(path)
+       logging.info("spool: replaying {}".format(path))
+       storage.save(reader.records(), reader.runtime)
+       os.remove(path)
+       count += 1
+     return count
+
+class SpoolWriter:
+
+   def __init__(self, path):
+     self.path = path
+     self.file = open(path + PART_SUFFIX, "w")
+     self.entries = 0
+     self.failed = False
+
+   def tee(self, inventory):
+     """Yield records of the inventory, spooling each before it is yielded."""
+     try:
+       for rec in inventory:
+         self.write(rec)
+         yield rec
+     except Exception:
+       # failed collection, spool is incomplete
+       self.failed = True
+       raise
+
+   def write(self, rec):
+     self.file.write(json.dumps(dict(rec), default=str))
+     self.file.write("\n")
+     self.entries += 1
+
+   def drain(self, inventory):
+     for rec in inventory:
+       self.write(rec)
+
+   def finish(self, runtime = None):
+     """Write trailer and publish the file (complete spool)."""
+     self.file.write(json.dumps({ "_spool": "end", "entries": self.entries, "runtime": runtime }))
+     self.file.write("\n")
+     self.file.flush()
+     os.fsync(self.file.fileno())
+     self.file.close()
+     os.rename(self.path + PART_SUFFIX, self.path)
+
+   def discard(self):
+     self.file.close()
+     os.remove(self.path + PART_SUFFIX)
+
+class SpoolReader:
+
+   def __init__(self, path):
+     self.path = path
+     self.trailer = None
+
+   def records(self):
+     with open(self.path) as file:
+       for line in file:
+         rec = json.loads(line)
+         if rec.get("_spool") == "end":
+           self.trailer = rec
+           return
+         yield rec
+     raise Exception("Spool file {} has no trailer".format(self.path))
+
+   def runtime(self):
+     # known after the records were read
+     return self.trailer["runtime"] if self.trailer else None
@@ -1,46 +1,241 @@
-import logging, re
+import logging, re, os, sys, io, threading, atexit, hashlib, functools, itertools, zlib
+import concurrent.futures
 from pprint import pprint
 from datetime import datetime, timedelta
-from sqlalchemy.pool import NullPool
+from sqlalchemy.pool import NullPool, QueuePool
 
 import sqlalchemy as sa
 
+# collectors change working directory, relative sqlite paths are resolved against the startup one
+from cloudinventario import STARTUP_DIR
+
+try:
+   import zstandard
+except ImportError:
+   zstandard = None
+
 TABLE_PREFIX = "ci_"
 
 STATUS_OK = "OK"
 STATUS_FAIL = "FAIL"
 STATUS_ERROR = "ERROR"
 
+LAYOUT_SNAPSHOT = "snapshot"
+LAYOUT_ENTITY = "entity"
+
+# bump together with a new migration in InventoryStorage.__migrations()
+SCHEMA_VERSION = 7
+
+BATCH_SIZE = 1000
+DELTA_UPDATE_SIZE = 500
+PRUNE_BATCH_VERSIONS = 10
+
+DETAILS_CODECS = ["zstd", "zlib"]
+
+POOL_SIZE = 5
+POOL_MAX_OVERFLOW = 10
+POOL_RECYCLE = 3600
+
+# applied to sqlite file databases in writer mode (storage.sqlite_writer)
+SQLITE_PRAGMAS = {
+  "journal_mode": "WAL",
+  "synchronous": "NORMAL",
+  "cache_size": -65536,
+  "temp_store": "MEMORY"
+}
+SQLITE_BUSY_TIMEOUT = 60000
+
+# shared storages (per process and DSN)
+_storages = {}
+_storages_lock = threading.Lock()
+
+def get_storage(config):
+   """Return long-lived storage shared by all collectors of this process."""
+   key = (os.getpid(), config["dsn"])
+   with _storages_lock:
+     if key not in _storages:
+       _storages[key] = InventoryStorage(config)
+     return _storages[key]
+
+def close_storages():
+   """Dispose shared storages (i.e. before forking)."""
+   with _storages_lock:
+     for key in list(_storages.keys()):
+       if key[0] == os.getpid():
+         _storages.pop(key).close()
+
+atexit.register(close_storages)
+
+def _copy_value(value):
+   if value is None:
+     return "\\N"
+   if isinstance(value, bool):
+     value = int(value)
+   return '"' + str(value).replace('"', '""') + '"'
+
+def _key_value(value):
+   return None if value is None else str(value)
+
+def _compress(codec, data):
+   if codec == "zstd":
+     return zstandard.ZstdCompressor().compress(data)
+   return zlib.compress(data)
+
+def _decompress(codec, data):
+   if codec == "zstd":
+     if zstandard is None:
+       raise Exception("zstandard is required to read zstd compressed details")
+     return zstandard.ZstdDecompressor().decompress(data)
+   return zlib.decompress(data)
+
 class InventoryStorage:
 
-   def __init__(self, config):
+   def __writes(fn):
+     """Run the storage write on the writer thread (if any)."""
+     @functools.wraps(fn)
+     def wrapper(self, *args, **kwargs):
+       return self.__submit(fn, self, *args, **kwargs).result()
+     return wrapper
+
+   def __init__(self, config, lock = None):
      self.config = config
-     self.dsn = config["dsn"]
+     self.dsn = self.__pin_dsn(config["dsn"])
+     self.lock = lock or threading.Lock()
+     self.writer = None
+     self.writer_ident = None
      self.engine = self.__create()
-     self.conn = None
+     if self.config.get("sqlite_writer", False) or self.config.get("single_writer", False):
+       self.__start_writer()
+     self.copy_insert = self.__copy_supported()
+     self.details_store = self.config.get("details_store", False)
+     self.details_codec = self.config.get("details_codec", "zstd" if zstandard else "zlib")
+     if self.details_codec not in DETAILS_CODECS or (self.details_codec == "zstd" and zstandard is None):
+       raise Exception("Unsupported details codec '{}'".format(self.details_codec))
+     self.schema_ready = False
+     self.schema_version = 0
      self.version = 0
+     self.__define_schema()
 
    def __del__(self):
-     if self.conn:
-       self.disconnect()
-     self.engine.dispose()
+     if hasattr(self, "engine"):
+       self.close()
 
    def __create(self):
-     return sa.create_engine(self.dsn, echo=False, poolclass=NullPool)
+     options = {
+       "echo": False,
+       "pool_pre_ping": self.config.get("pool_pre_ping", True)
+     }
+
+     url = sa.engine.url.make_url(self.dsn)
+     if self.config.get("pool", True) is False:
+       options["poolclass"] = NullPool
+     elif url.get_backend_name() == "sqlite":
+       # file databases are shared by collector threads, memory ones keep the default pool
+       if url.database not in [None, "", ":memory:"]:
+         options["poolclass"] = QueuePool
+         options["connect_args"] = {
+           "check_same_thread": False,
+           "timeout": self.config.get("sqlite_busy_timeout", SQLITE_BUSY_TIMEOUT) / 1000
+         }
+         if self.config.get("sqlite_writer", False):
+           engine = sa.create_engine(self.dsn, **options)
+           self.__setup_sqlite_wal(engine)
+           return engine
+     else:
+       options["pool_size"] = self.config.get("pool_size", POOL_SIZE)
+       options["max_overflow"] = self.config.get("pool_max_overflow", POOL_MAX_OVERFLOW)
+       options["pool_recycle"] = self.config.get("pool_recycle", POOL_RECYCLE)
+
+     return sa.create_engine(self.dsn, **options)
+
+   def __setup_sqlite_wal(self, engine):
+     """WAL (readers do not block the writer) and pragmas, used with one writer thread per process.
+
+     Writers of other processes wait for the database lock (busy timeout),
+     transactions take it upfront (BEGIN IMMEDIATE) so they never fail on lock upgrade.
+     """
+     pragmas = dict(SQLITE_PRAGMAS)
+     pragmas.update(self.config.get("sqlite_pragmas", {}))
+     pragmas["busy_timeout"] = self.config.get("sqlite_busy_timeout", SQLITE_BUSY_TIMEOUT)
+
+     @sa.event.listens_for(engine, "connect")
+     def connect(dbapi_conn, record):
+       # transactions are started by the begin event below
+       dbapi_conn.isolation_level = None
+       cursor = dbapi_conn.cursor()
+       for name, value in pragmas.items():
+         cursor.execute("PRAGMA {} = {}".format(name, value))
+       cursor.close()
+
+     @sa.event.listens_for(engine, "begin")
+     def begin(conn):
+       conn.execute("BEGIN IMMEDIATE")
+
+   def __start_writer(self):
+     def init():
+       self.writer_ident = threading.get_ident()
+     self.writer = concurrent.futures.ThreadPoolExecutor(max_workers = 1,
+                     thread_name_prefix = "storage-writer", initializer = init)
+
+   def __submit(self, fn, *args, **kwargs):
+     """Queue the write for the writer thread, or run it now (returns a future either way)."""
+     if self.writer is not None and threading.get_ident() != self.writer_ident:
+       return self.writer.submit(fn, *args, **kwargs)
+
+     future = concurrent.futures.Future()
+     try:
+       future.set_result(fn(*args, **kwargs))
+     except Exception as e:
+       future.set_exception(e)
+     return future
+
+   def __copy_supported(self):
+     # COPY FROM STDIN is reachable through the psycopg2 cursor only
+     return (self.config.get("copy", True) and
+               self.engine.dialect.name == "postgresql" and
+               self.engine.dialect.driver == "psycopg2")
+
+   def __pin_dsn(self, dsn):
+     m = re.match(r'^(sqlite[^:]*:///)([^?]+)(.*)$', dsn)
+     if m and m.group(2) != ":memory:" and not os.path.isabs(m.group(2)):
+       dsn = m.group(1) + os.path.join(STARTUP_DIR, m.group(2)) + m.group(3)
+     return dsn
 
    def connect(self):
-     self.conn = self.engine.connect()
-     #self.conn.execution_options(autocommit=True)
-     if not self.__check_schema():
-       self.__create_schema()
-     self.__prepare();
+     # schema is set up once per storage, connections come from the pool
+     with self.lock:
+       if not self.schema_ready:
+         if not self.__check_schema():
+           try:
+             self.__create_schema()
+           except sa.exc.DBAPIError:
+             # other process may have been upgrading concurrently
+             if not self.__check_schema():
+               raise
+         self.__prepare();
+         self.schema_ready = True
      return True
 
    def __check_schema(self):
-     return False
+     # fast path, a single query when the schema is up to date
+     try:
+       with self.engine.connect() as conn:
+         version = conn.execute(sa.select([sa.func.max(self.schema_table.c.version)])).scalar()
+     except sa.exc.DBAPIError:
+       # no schema table yet
+       return False
+     self.schema_version = version or 0
+     return self.schema_version >= SCHEMA_VERSION
+
+   def __define_schema(self):
+     # tables always describe the latest schema version
+     self.meta = meta = sa.MetaData()
+     self.schema_table = sa.Table(TABLE_PREFIX + 'schema', meta,
+       sa.Column('version', sa.Integer, primary_key=True, autoincrement=False),
+       sa.Column('ts', sa.DateTime, default=sa.func.now()),
+       sa.Column('description', sa.String)
+     )
 
-   def __create_schema(self):
-     meta = sa.MetaData()
      self.source_table = sa.Table(TABLE_PREFIX + 'source', meta,
        sa.Column('id', sa.Integer, primary_key=True, autoincrement=True),
        sa.Column('ts', sa.String, default=sa.func.now()),
@@ -50,14 +245,96 @@ class InventoryStorage:
        sa.Column('entries', sa.Integer),
        sa.Column('status', sa.String),
        sa.Column('error', sa.Text),
+       sa.Column('created_at', sa.DateTime, default=datetime.utcnow),
+
+       sa.UniqueConstraint('source', 'version'),
 
-       sa.UniqueConstraint('source', 'version')
+       sa.Index(TABLE_PREFIX + 'source_created_at_idx', 'created_at')
      )
 
+     # latest allocated version of each source
+     self.source_latest_table = sa.Table(TABLE_PREFIX + 'source_latest', meta,
+       sa.Column('source', sa.String, primary_key=True),
+       sa.Column('version', sa.Integer, nullable=False)
+     )
+
+     # row is valid for versions version .. version_last (unchanged records are not stored again in delta mode)
      self.inventory_table = sa.Table(TABLE_PREFIX + 'inventory', meta,
        sa.Column('inventory_id', sa.Integer, primary_key=True, autoincrement=True),
        sa.Column('version', sa.Integer),
+       sa.Column('version_last', sa.Integer),
+       sa.Column('hash', sa.String(40)),
+
+       *self.__data_columns(),
+
+       sa.UniqueConstraint('version', 'source', 'type', 'name', "cluster", 'project', 'id'),
 
+       sa.Index(TABLE_PREFIX + 'inventory_source_version_idx', 'source', 'version'),
+       sa.Index(TABLE_PREFIX + 'inventory_type_idx', 'type'),
+       sa.Index(TABLE_PREFIX + 'inventory_primary_ip_idx', 'primary_ip'),
+       sa.Index(TABLE_PREFIX + 'inventory_id_idx', 'id'),
+       sa.Index(TABLE_PREFIX + 'inventory_source_version_last_idx', 'source', 'version_last'),
+       sa.Index(TABLE_PREFIX + 'inventory_details_hash_idx', 'details_hash')
+     )
+
+     # compressed details, shared by all records (and versions) with the same content
+     self.details_table = sa.Table(TABLE_PREFIX + 'details', meta,
+       sa.Column('hash', sa.String(40), primary_key=True),
+       sa.Column('codec', sa.String(8), nullable=False),
+       sa.Column('size', sa.Integer),
+       sa.Column('data', sa.LargeBinary)
+     )
+
+     # current state of each entity (source, type, id), state is valid for versions version_changed .. version_last
+     self.entity_table = sa.Table(TABLE_PREFIX + 'entity', meta,
+       sa.Column('entity_id', sa.Integer, primary_key=True, autoincrement=True),
+       sa.Column('entity_key', sa.String, nullable=False),
+       sa.Column('first_seen', sa.DateTime),
+       sa.Column('last_seen', sa.DateTime),
+       sa.Column('changed_at', sa.DateTime),
+       sa.Column('version_first', sa.Integer),
+       sa.Column('version_changed', sa.Integer),
+       sa.Column('version_last', sa.Integer),
+       sa.Column('hash', sa.String(40)),
+
+       *self.__data_columns(),
+
+       sa.UniqueConstraint('source', 'type', 'entity_key'),
+
+       sa.Index(TABLE_PREFIX + 'entity_type_idx', 'type'),
+       sa.Index(TABLE_PREFIX + 'entity_primary_ip_idx', 'primary_ip'),
+       sa.Index(TABLE_PREFIX + 'entity_id_idx', 'id'),
+       sa.Index(TABLE_PREFIX + 'entity_details_hash_idx', 'details_hash')
+     )
+
+     # previous states of entities (changed or gone)
+     self.entity_history_table = sa.Table(TABLE_PREFIX + 'entity_history', meta,
+       sa.Column('history_id', sa.Integer, primary_key=True, autoincrement=True),
+       sa.Column('entity_id', sa.Integer),
+       sa.Column('entity_key', sa.String, nullable=False),
+       sa.Column('valid_from', sa.DateTime),
+       sa.Column('valid_to', sa.DateTime),
+       sa.Column('version_from', sa.Integer),
+       sa.Column('version_to', sa.Integer),
+       sa.Column('hash', sa.String(40)),
+
+       *self.__data_columns(),
+
+       sa.Index(TABLE_PREFIX + 'entity_history_entity_idx', 'entity_id'),
+       sa.Index(TABLE_PREFIX + 'entity_history_source_version_idx', 'source', 'version_to'),
+       sa.Index(TABLE_PREFIX + 'entity_history_valid_to_idx', 'valid_to'),
+       sa.Index(TABLE_PREFIX + 'entity_history_details_hash_idx', 'details_hash')
+     )
+
+     # entity identity and content used for the hash
+     self.key_columns = ['type', 'name', 'cluster', 'project', 'id']
+     self.data_columns = [col.name for col in self.__data_columns()]
+     self.hash_columns = [col.name for col in self.inventory_table.columns
+                            if col.name not in ['inventory_id', 'version', 'version_last', 'hash', 'details_hash']]
+
+   def __data_columns(self):
+     # record columns, shared by the snapshot and entity layouts
+     return [
        sa.Column('source', sa.String),
        sa.Column('type', sa.String),
        sa.Column('name', sa.String),
@@ -88,116 +365,787 @@ class InventoryStorage:
 
        sa.Column('description', sa.String),
        sa.Column('attributes', sa.Text),
-       sa.Column('details', sa.Text),
+       # details moved to ci_details (storage.details_store)
+       sa.Column('details_hash', sa.String(40)),
+       sa.Column('details', sa.Text)
+     ]
 
-       sa.UniqueConstraint('version', 'source', 'type', 'name', "cluster", 'project', 'id')
-     )
+   def __create_schema(self):
+     with self.engine.begin() as conn:
+       tables = sa.inspect(conn).get_table_names()
+
+       if self.schema_table.name not in tables and self.source_table.name not in tables:
+         # new storage, create the latest schema directly
+         logging.info("creating storage schema version={}".format(SCHEMA_VERSION))
+         self.meta.create_all(conn, checkfirst = True)
+         self.__stamp_schema(conn, SCHEMA_VERSION, "initial schema")
+         return True
 
-     meta.create_all(self.engine, checkfirst = True)
+       if self.schema_table.name not in tables:
+         # storage created before schema versioning (version 1)
+         self.schema_table.create(conn, checkfirst = True)
+         self.__stamp_schema(conn, 1, "initial schema")
+         self.schema_version = 1
+
+     for version, description, migrate, transactional in self.__migrations():
+       if version <= self.schema_version:
+         continue
+       logging.info("migrating storage schema version={}: {}".format(version, description))
+       if transactional:
+         with self.engine.begin() as conn:
+           migrate(conn)
+           self.__stamp_schema(conn, version, description)
+       else:
+         with self.engine.connect() as conn:
+           conn = conn.execution_options(isolation_level = "AUTOCOMMIT")
+           migrate(conn)
+           self.__stamp_schema(conn, version, description)
+       self.schema_version = version
      return True
 
-   def __prepare(self):
-     pass
+   def __migrations(self):
+     # (version, description, callable(conn), transactional) in ascending order
+     return [
+       (2, "inventory indexes", self.__migrate_inventory_indexes, not self.__concurrent_indexes()),
+       (3, "source latest versions", self.__migrate_source_latest, True),
+       (4, "source timestamps", self.__migrate_source_created_at, True),
+       (5, "inventory delta versions", self.__migrate_inventory_delta, True),
+       (6, "entity layout", self.__migrate_entities, True),
+       (7, "details store", self.__migrate_details, True)
+     ]
+
+   def __concurrent_indexes(self):
+     # CREATE INDEX CONCURRENTLY does not block writers, but can't run in a transaction
+     return self.config.get("concurrent_indexes", False) and self.engine.dialect.name == "postgresql"
+
+   def __migrate_inventory_indexes(self, conn):
+     for index in self.inventory_table.indexes:
+       # indexes on columns added by later migrations
+       if index.name not in [TABLE_PREFIX + 'inventory_source_version_last_idx',
+                             TABLE_PREFIX + 'inventory_details_hash_idx']:
+         self.__add_index(conn, self.inventory_table, index.name)
+
+   def __migrate_source_latest(self, conn):
+     self.source_latest_table.create(conn, checkfirst = True)
+     conn.execute(self.source_latest_table.insert().from_select(["source", "version"],
+                    sa.select([
+                      self.source_table.c.source,
+                      sa.func.max(self.source_table.c.version)])
+                    .group_by(self.source_table.c.source)))
 
-   def __get_sources_version_max(self):
-     # get active version
-     res = self.conn.execute(sa.select([
-                   self.source_table.c.source,
-                   sa.func.max(self.source_table.c.version).label("version")])
-     	              .group_by(self.source_table.c.source))
-     res = res.fetchall()
-     if res and res[0]["version"]:
-       sources = [dict(row) for row in res]
+   def __stamp_schema(self, conn, version, description):
+     conn.execute(self.schema_table.insert(), {
+       "version": version,
+       "description": description
+     })
+
+   def __migrate_source_created_at(self, conn):
+     self.__add_column(conn, self.source_table, "created_at")
+
+     # ts is a string, sqlite compares it as is, the rest has to parse it
+     if conn.dialect.name == "sqlite":
+       created_at = self.source_table.c.ts
+     elif conn.dialect.name == "postgresql":
+       # now() stored with the session offset, created_at is naive UTC
+       created_at = sa.func.timezone('UTC', sa.cast(self.source_table.c.ts, sa.DateTime(timezone = True)))
      else:
-       sources = []
-     return sources
+       created_at = sa.cast(self.source_table.c.ts, sa.DateTime)
+     conn.execute(self.source_table.update().values(created_at = created_at))
+
+     self.__add_index(conn, self.source_table, TABLE_PREFIX + 'source_created_at_idx')
+
+   def __migrate_inventory_delta(self, conn):
+     self.__add_column(conn, self.inventory_table, "version_last")
+     # hash is left NULL, it can't be rebuilt from stored values (types differ from collected ones),
+     # so the first delta run after the migration stores all records once
+     self.__add_column(conn, self.inventory_table, "hash")
+     conn.execute(self.inventory_table.update().values(version_last = self.inventory_table.c.version))
+     self.__add_index(conn, self.inventory_table, TABLE_PREFIX + 'inventory_source_version_last_idx')
+
+   def __migrate_entities(self, conn):
+     self.entity_table.create(conn, checkfirst = True)
+     self.entity_history_table.create(conn, checkfirst = True)
 
-   def __get_source_version_max(self, name):
-     sources = self.__get_sources_version_max()
-     for source in sources:
-       if name == source["source"]:
-         return source["version"]
-     return 0
+   def __migrate_details(self, conn):
+     self.details_table.create(conn, checkfirst = True)
+     for table in [self.inventory_table, self.entity_table, self.entity_history_table]:
+       self.__add_column(conn, table, "details_hash")
+     self.__add_index(conn, self.inventory_table, TABLE_PREFIX + 'inventory_details_hash_idx')
+     self.__add_index(conn, self.entity_table, TABLE_PREFIX + 'entity_details_hash_idx')
+     self.__add_index(conn, self.entity_history_table, TABLE_PREFIX + 'entity_history_details_hash_idx')
+
+   def __add_column(self, conn, table, name):
+     # tables created by a later definition have the column already
+     existing = [column["name"] for column in sa.inspect(conn).get_columns(table.name)]
+     if name in existing:
+       return False
+
+     column = table.c[name]
+     conn.execute(sa.text("ALTER TABLE {} ADD COLUMN {} {}".format(
+       table.name, column.name, column.type.compile(dialect = conn.dialect))))
+     return True
+
+   def __add_index(self, conn, table, name):
+     for index in table.indexes:
+       if index.name == name:
+         break
+     else:
+       raise Exception("Index '{}' not defined on {}".format(name, table.name))
+
+     # indexes may exist already (i.e. a previous run of an interrupted migration)
+     existing = [index["name"] for index in sa.inspect(conn).get_indexes(table.name)]
+     rebuild = False
+     if name in existing:
+       # an interrupted concurrent build leaves an invalid index behind
+       if not self.__invalid_index(conn, name):
+         return False
+       logging.warning("rebuilding invalid index={}".format(name))
+       rebuild = True
+
+     concurrently = self.__concurrent_indexes()
+     index.dialect_kwargs["postgresql_concurrently"] = concurrently
+     try:
+       if rebuild:
+         index.drop(conn)
+       index.create(conn)
+     finally:
+       index.dialect_kwargs["postgresql_concurrently"] = False
+     return True
+
+   def __invalid_index(self, conn, name):
+     if conn.dialect.name != "postgresql":
+       return False
+     return conn.execute(sa.text("SELECT NOT i.indisvalid FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid"
+                                 " WHERE c.relname = :name AND pg_table_is_visible(c.oid)"), name = name).scalar() or False
+
+   def __prepare(self):
+     pass
+
+   @__writes
+   def __allocate_version(self, source, action = None):
+     """Allocate next version of the source, action(conn, version) runs in the same transaction."""
+     latest = self.source_latest_table
+     for attempt in range(2):
+       try:
+         with self.lock, self.engine.begin() as conn:
+           # row lock on the source serializes concurrent workers
+           res = conn.execute(latest.update()
+                   .where(latest.c.source == source)
+                   .values(version = latest.c.version + 1))
+           if res.rowcount == 0:
+             version = 1
+             conn.execute(latest.insert(), { "source": source, "version": version })
+           else:
+             version = conn.execute(sa.select([latest.c.version])
+                         .where(latest.c.source == source)).scalar()
+           if action:
+             action(conn, version)
+           return version
+       except sa.exc.IntegrityError:
+         # source was inserted concurrently, the retry increments it
+         if attempt > 0:
+           raise
 
    def log_status(self, source, status, runtime = None, error = None):
-     version = self.__get_source_version_max(source)
-
-     data = {
-       "source": source,
-       "version": version + 1,
-       "status": status,
-       "runtime": runtime,
-       "error": error
-     }
+     def insert(conn, version):
+       conn.execute(self.source_table.insert(), {
+         "source": source,
+         "version": version,
+         "status": status,
+         "runtime": runtime,
+         "error": error
+       })
 
-     with self.engine.begin() as conn:
-       conn.execute(self.source_table.insert(), data)
+     self.__allocate_version(source, insert)
      return True
 
    def save(self, data, runtime = None):
      if data is None:
        return False
 
-     sources = self.__get_sources_version_max()
+     batch_size = self.config.get("batch_size", BATCH_SIZE)
+     entity_layout = self.config.get("layout", LAYOUT_SNAPSHOT) == LAYOUT_ENTITY
 
-     # increment versions
-     versions = {}
-     for source in sources:
-       source["version"] += 1
-       versions[source["source"]] = source["version"]
+     # in delta mode, only new or changed records are inserted
+     previous = None
+     if self.config.get("delta", False) and not entity_layout:
+       previous = {}
+
+     # data may be a (lazy) iterable, records are written in batches as they arrive
+     # batches are written while the next one is being fetched
+     write_batch = self.__upsert_entities if entity_layout else self.__insert_batch
+     pending = None
 
-     # collect data sources versions
+     versions = {}
      entries = {}
-     for rec in data:
-       if rec["source"] not in versions.keys():
-         versions[rec["source"]] = 1
-         sources.append({ "source": rec["source"],
-                          "version": versions[rec["source"]] })
-       rec["version"] = versions.get(rec["source"], 1)
-       entries.setdefault(rec["source"], 0)
-       entries[rec["source"]] += 1
-
-     # save entry counts
+     seen = {}
+     batch = []
+     try:
+       for rec in data:
+         source = rec["source"]
+         if source not in versions:
+           # versions are never reused, failed runs leave a gap
+           versions[source] = self.__allocate_version(source)
+           entries[source] = 0
+           seen[source] = datetime.utcnow()
+           if previous is not None:
+             previous[source] = self.__find_previous(source, versions[source])
+         rec["version"] = versions[source]
+         rec["version_last"] = versions[source]
+         rec["hash"] = self.__record_hash(rec)
+         entries[source] += 1
+
+         batch.append(rec)
+         if len(batch) >= batch_size:
+           if pending:
+             pending.result()
+           pending = self.__submit(write_batch, batch, seen if entity_layout else previous)
+           batch = []
+
+       if len(batch) > 0:
+         if pending:
+           pending.result()
+         pending = self.__submit(write_batch, batch, seen if entity_layout else previous)
+       if pending:
+         pending.result()
+
+       # entities not seen in this run are gone
+       if entity_layout:
+         for source, version in versions.items():
+           self.__retire_entities(source, version, seen[source])
+     except Exception:
+       if pending and not pending.done():
+         concurrent.futures.wait([pending])
+
+       # entity rows are updated in place, their previous state is restored
+       for source, version in versions.items():
+         try:
+           if entity_layout:
+             self.__rollback_entities(source, version, seen[source])
+           else:
+             self.__purge_version(source, version)
+         except Exception as e:
+           logging.error("failed to purge partial data source={}, version={}: {}".format(source, version, e))
+       raise
+
+     if len(versions) == 0:
+       return False
+
+     # runtime is known only after the data were consumed
+     if callable(runtime):
+       runtime = runtime()
+
+     # save entry counts (this marks the versions as complete)
      sources_save = []
-     for source in sources:
-       if not source["source"] in entries:
+     for source, version in versions.items():
+       sources_save.append({
+         "source": source,
+         "version": version,
+         "entries": entries[source],
+         "status": STATUS_OK,
+         "runtime": runtime
+       })
+
+     self.__save_sources(sources_save)
+     return True
+
+   @__writes
+   def __save_sources(self, sources):
+     with self.lock, self.engine.begin() as conn:
+       conn.execute(self.source_table.insert(), sources)
+
+   def __insert_batch(self, batch, previous = None):
+     with self.lock, self.engine.begin() as conn:
+       # unchanged records extend validity of their previous row
+       extend = {}
+       if previous is not None:
+         prev_rows = self.__load_previous(conn, batch, previous)
+         changed = []
+         for rec in batch:
+           prev = prev_rows.pop((rec["source"],) + self.__record_key(rec), None)
+           if prev and prev[1] == rec["hash"]:
+             extend.setdefault(rec["version"], []).append(prev[0])
+           else:
+             changed.append(rec)
+         batch = changed
+
+       if len(batch) > 0:
+         if self.details_store:
+           self.__store_details(conn, batch)
+         self.__bulk_insert(conn, self.inventory_table, batch)
+       for version, ids in extend.items():
+         for idx in range(0, len(ids), DELTA_UPDATE_SIZE):
+           conn.execute(self.inventory_table.update()
+                          .where(self.inventory_table.c.inventory_id.in_(ids[idx:idx + DELTA_UPDATE_SIZE]))
+                          .values(version_last = version))
+
+   def __entity_key(self, rec):
+     # some resources have no id, their name identifies them
+     key = rec.get("id")
+     if key is None:
+       key = rec.get("name")
+     return str(key)
+
+   def __entity_row(self, rec):
+     row = { col: rec.get(col) for col in self.data_columns }
+     row["hash"] = rec["hash"]
+     return row
+
+   def __history_select(self, valid_to):
+     """Select current entity rows as history rows (columns in history_columns order)."""
+     ent = self.entity_table
+     return sa.select([ent.c.entity_id, ent.c.entity_key,
+                       ent.c.changed_at, sa.literal(valid_to, sa.DateTime),
+                       ent.c.version_changed, ent.c.version_last, ent.c.hash]
+                      + [ent.c[col] for col in self.data_columns])
+
+   def __history_columns(self):
+     return (['entity_id', 'entity_key', 'valid_from', 'valid_to', 'version_from', 'version_to', 'hash']
+             + self.data_columns)
+
+   def __upsert_entities(self, batch, seen):
+     """Insert new entities, extend unchanged ones and move changed ones' old state to history."""
+     ent = self.entity_table
+     hist = self.entity_history_table
+
+     # last record wins for entities repeated in the batch
+     records = {}
+     for rec in batch:
+       records[(rec["source"], rec["type"], self.__entity_key(rec))] = rec
+
+     # lookups by (source, type, entity_key) use the whole unique index
+     by_type = {}
+     for key in records.keys():
+       by_type.setdefault(key[:2], set()).add(key[2])
+
+     with self.lock, self.engine.begin() as conn:
+       current = {}
+       for (source, rectype), keys in by_type.items():
+         keys = list(keys)
+         for idx in range(0, len(keys), DELTA_UPDATE_SIZE):
+           res = conn.execute(sa.select([ent.c.entity_id, ent.c.source, ent.c.type, ent.c.entity_key,
+                                         ent.c.hash, ent.c.version_last])
+                   .where((ent.c.source == source) &
+                            (ent.c.type == rectype) &
+                            ent.c.entity_key.in_(keys[idx:idx + DELTA_UPDATE_SIZE])))
+           for row in res:
+             current[(row["source"], row["type"], row["entity_key"])] = row
+
+       inserts = []
+       extend = {}
+       changed = []
+       archive = {}
+       for key, rec in records.items():
+         now = seen[rec["source"]]
+         version = rec["version"]
+         row = current.get(key)
+         if row is None:
+           values = self.__entity_row(rec)
+           values.update({
+             "entity_key": key[2],
+             "first_seen": now,
+             "last_seen": now,
+             "changed_at": now,
+             "version_first": version,
+             "version_changed": version,
+             "version_last": version
+           })
+           inserts.append(values)
+         elif row["hash"] == rec["hash"]:
+           extend.setdefault((version, now), []).append(row["entity_id"])
+         else:
+           values = self.__entity_row(rec)
+           values.update({
+             "_entity_id": row["entity_id"],
+             "version_last": version
+           })
+           # state already written by this run is simply replaced
+           if row["version_last"] != version:
+             archive.setdefault(now, []).append(row["entity_id"])
+             values.update({
+               "changed_at": now,
+               "version_changed": version
+             })
+           changed.append(values)
+
+       # batches may mix sources, history rows end at the seen time of their source (see __rollback_entities)
+       for now, ids in archive.items():
+         for idx in range(0, len(ids), DELTA_UPDATE_SIZE):
+           conn.execute(hist.insert().from_select(self.__history_columns(),
+                          self.__history_select(now)
+                            .where(ent.c.entity_id.in_(ids[idx:idx + DELTA_UPDATE_SIZE]))))
+       if self.details_store:
+         self.__store_details(conn, inserts + changed)
+       if len(inserts) > 0:
+         self.__bulk_insert(conn, ent, inserts)
+       if len(changed) > 0:
+         # executemany needs uniform parameter sets
+         for values in [v for v in changed if "changed_at" in v], [v for v in changed if "changed_at" not in v]:
+           if len(values) > 0:
+             conn.execute(ent.update().where(ent.c.entity_id == sa.bindparam("_entity_id")), values)
+       # last_seen is set once the run succeeded (see __retire_entities), a failed run is rolled back
+       for (version, now), ids in extend.items():
+         for idx in range(0, len(ids), DELTA_UPDATE_SIZE):
+           conn.execute(ent.update()
+                          .where(ent.c.entity_id.in_(ids[idx:idx + DELTA_UPDATE_SIZE]))
+                          .values(version_last = version))
+
+   @__writes
+   def __retire_entities(self, source, version, now):
+     ent = self.entity_table
+     gone = (ent.c.source == source) & (ent.c.version_last < version)
+     with self.lock, self.engine.begin() as conn:
+       conn.execute(ent.update()
+                      .where((ent.c.source == source) & (ent.c.version_last == version))
+                      .values(last_seen = now))
+       conn.execute(self.entity_history_table.insert().from_select(self.__history_columns(),
+                      self.__history_select(now).where(gone)))
+       conn.execute(ent.delete().where(gone))
+
+   @__writes
+   def __rollback_entities(self, source, version, now):
+     """Restore the entities of a source as they were before a failed run."""
+     ent = self.entity_table
+     hist = self.entity_history_table
+     with self.lock, self.engine.begin() as conn:
+       # new entities
+       conn.execute(ent.delete().where((ent.c.source == source) & (ent.c.version_first == version)))
+
+       # changed entities get their archived state back
+       changed = [row["entity_id"] for row in conn.execute(sa.select([ent.c.entity_id])
+                    .where((ent.c.source == source) & (ent.c.version_changed == version)))]
+       for idx in range(0, len(changed), DELTA_UPDATE_SIZE):
+         ids = changed[idx:idx + DELTA_UPDATE_SIZE]
+         archived = (hist.c.source == source) & (hist.c.valid_to == now) & hist.c.entity_id.in_(ids)
+         restore = []
+         for row in conn.execute(sa.select([hist]).where(archived)):
+           values = { col: row[col] for col in self.data_columns }
+           values.update({
+             "_entity_id": row["entity_id"],
+             "hash": row["hash"],
+             "changed_at": row["valid_from"],
+             "version_changed": row["version_from"],
+             "version_last": row["version_to"]
+           })
+           restore.append(values)
+         if len(restore) > 0:
+           conn.execute(ent.update().where(ent.c.entity_id == sa.bindparam("_entity_id")), restore)
+         conn.execute(hist.delete().where(archived))
+
+       # unchanged entities were only extended
+       prev = self.__previous_version(conn, source, version)
+       if prev is not None:
+         conn.execute(ent.update()
+                        .where((ent.c.source == source) & (ent.c.version_last == version))
+                        .values(version_last = prev))
+
+   def __bulk_insert(self, conn, table, rows):
+     """Insert rows by COPY on PostgreSQL, by executemany (bounded by the batch size) elsewhere."""
+     if self.copy_insert:
+       self.__copy_insert(conn, table, rows)
+     else:
+       conn.execute(table.insert(), rows)
+
+   def __copy_insert(self, conn, table, rows):
+     preparer = self.engine.dialect.identifier_preparer
+     columns = [col.name for col in table.columns if col.name in rows[0]]
+
+     # CSV with an unquoted \N for NULL, all values are quoted so empty strings stay empty
+     buf = io.StringIO()
+     for row in rows:
+       buf.write(",".join([_copy_value(row.get(col)) for col in columns]))
+       buf.write("\n")
+     buf.seek(0)
+
+     sql = "COPY {} ({}) FROM STDIN WITH (FORMAT csv, NULL '\\N')".format(
+             preparer.format_table(table), ", ".join([preparer.quote(col) for col in columns]))
+     cursor = conn.connection.cursor()
+     try:
+       cursor.copy_expert(sql, buf)
+     finally:
+       cursor.close()
+
+   def __store_details(self, conn, rows):
+     """Move details of the rows to ci_details, rows keep only their hash."""
+     blobs = {}
+     for row in rows:
+       details = row.get("details")
+       if details is None:
          continue
-       source["entries"] = entries[source["source"]]
-       source["status"] = STATUS_OK
-       source["runtime"] = runtime
-       sources_save.append(source)
+       digest = hashlib.blake2b(details.encode("utf-8"), digest_size = 20).hexdigest()
+       row["details_hash"] = digest
+       row["details"] = None
+       blobs[digest] = details
+
+     hashes = list(blobs.keys())
+     for idx in range(0, len(hashes), DELTA_UPDATE_SIZE):
+       res = conn.execute(sa.select([self.details_table.c.hash])
+               .where(self.details_table.c.hash.in_(hashes[idx:idx + DELTA_UPDATE_SIZE])))
+       for row in res:
+         del blobs[row[0]]
+
+     if len(blobs) > 0:
+       values = []
+       for digest, details in blobs.items():
+         data = details.encode("utf-8")
+         values.append({
+           "hash": digest,
+           "codec": self.details_codec,
+           "size": len(data),
+           "data": _compress(self.details_codec, data)
+         })
+       conn.execute(self.__insert_ignore(self.details_table), values)
+
+   def __insert_ignore(self, table):
+     # concurrent writers may store the same row
+     if self.engine.dialect.name == "postgresql":
+       from sqlalchemy.dialects import postgresql
+       return postgresql.insert(table).on_conflict_do_nothing()
+     elif self.engine.dialect.name == "sqlite":
+       return table.insert().prefix_with("OR IGNORE")
+     elif self.engine.dialect.name == "mysql":
+       return table.insert().prefix_with("IGNORE")
+     return table.insert()
+
+   def __load_details(self, conn, records):
+     """Yield records with details restored from ci_details."""
+     while True:
+       chunk = list(itertools.islice(records, DELTA_UPDATE_SIZE))
+       if len(chunk) == 0:
+         return
+
+       hashes = set([rec["details_hash"] for rec in chunk
+                       if rec.get("details") is None and rec.get("details_hash")])
+       blobs = {}
+       if hashes:
+         res = conn.execute(sa.select([self.details_table])
+                 .where(self.details_table.c.hash.in_(list(hashes))))
+         for row in res:
+           blobs[row["hash"]] = _decompress(row["codec"], row["data"]).decode("utf-8")
+
+       for rec in chunk:
+         if rec.get("details") is None and rec.get("details_hash"):
+           rec["details"] = blobs.get(rec["details_hash"])
+         yield rec
+
+   def __record_key(self, rec):
+     # key columns are strings, stored rows come back as such (i.e. integer ids)
+     return tuple(_key_value(rec.get(col)) for col in self.key_columns)
+
+   def __record_hash(self, rec):
+     content = "\x1f".join([str(rec.get(col)) for col in self.hash_columns])
+     return hashlib.blake2b(content.encode("utf-8"), digest_size = 20).hexdigest()
+
+   def __previous_version(self, conn, source, version):
+     return conn.execute(sa.select([sa.func.max(self.source_table.c.version)])
+              .where((self.source_table.c.source == source) &
+                       (self.source_table.c.status == STATUS_OK) &
+                       (self.source_table.c.version < version))).scalar()
+
+   def __find_previous(self, source, version):
+     with self.engine.connect() as conn:
+       return self.__previous_version(conn, source, version)
+
+   def __load_previous(self, conn, batch, previous):
+     """Rows of the previous stored version matching the batch records, (source, key) -> (inventory_id, hash)."""
+     inv = self.inventory_table
+
+     # looked up by id (name for records without one), the whole key is compared below
+     by_type = {}
+     for rec in batch:
+       if previous[rec["source"]] is not None:
+         ids, names = by_type.setdefault((rec["source"], rec["type"]), (set(), set()))
+         if rec.get("id") is not None:
+           ids.add(_key_value(rec["id"]))
+         else:
+           names.add(_key_value(rec.get("name")))
+
+     rows = {}
+     for (source, rectype), (ids, names) in by_type.items():
+       prev = previous[source]
+       ids = list(ids)
+       conds = [inv.c.id.in_(ids[idx:idx + DELTA_UPDATE_SIZE]) for idx in range(0, len(ids), DELTA_UPDATE_SIZE)]
+       if None in names:
+         names.discard(None)
+         conds.append((inv.c.id == None) & (inv.c.name == None))
+       names = list(names)
+       conds += [(inv.c.id == None) & inv.c.name.in_(names[idx:idx + DELTA_UPDATE_SIZE])
+                   for idx in range(0, len(names), DELTA_UPDATE_SIZE)]
+       for cond in conds:
+         res = conn.execute(sa.select([inv.c.inventory_id, inv.c.hash] + [inv.c[col] for col in self.key_columns])
+                 .where((inv.c.source == source) &
+                          (inv.c.type == rectype) &
+                          (inv.c.version_last >= prev) &
+                          (inv.c.version <= prev) &
+                          cond))
+         for row in res:
+           rows[(source,) + tuple(_key_value(row[col]) for col in self.key_columns)] = (row["inventory_id"], row["hash"])
+     return rows
 
-     if len(sources) == 0:
+   def load(self, source, version = None):
+     """Yield records of the given (default: latest stored) version of the source."""
+     if self.config.get("layout", LAYOUT_SNAPSHOT) == LAYOUT_ENTITY:
+       yield from self.__load_entities(source, version)
+       return
+
+     inv = self.inventory_table
+     with self.engine.connect() as conn:
+       if version is None:
+         version = self.__previous_version(conn, source, sys.maxsize)
+         if version is None:
+           return
+
+       res = conn.execute(sa.select([inv])
+               .where((inv.c.source == source) &
+                        (inv.c.version <= version) &
+                        (inv.c.version_last >= version))
+               .order_by(inv.c.inventory_id))
+       for rec in self.__load_details(conn, (dict(row) for row in res)):
+         rec["version"] = version
+         yield rec
+
+   def __load_entities(self, source, version = None):
+     ent = self.entity_table
+     hist = self.entity_history_table
+     with self.engine.connect() as conn:
+       # current state, no history needed
+       if version is None:
+         res = conn.execute(sa.select([ent])
+                 .where(ent.c.source == source)
+                 .order_by(ent.c.entity_id))
+         for rec in self.__load_details(conn, (dict(row) for row in res)):
+           rec["version"] = rec["version_last"]
+           yield rec
+         return
+
+       queries = [
+         sa.select([ent.c.entity_id, ent.c.hash] + [ent.c[col] for col in self.data_columns])
+           .where((ent.c.source == source) &
+                    (ent.c.version_changed <= version) &
+                    (ent.c.version_last >= version)),
+         sa.select([hist.c.entity_id, hist.c.hash] + [hist.c[col] for col in self.data_columns])
+           .where((hist.c.source == source) &
+                    (hist.c.version_from <= version) &
+                    (hist.c.version_to >= version))
+       ]
+       for query in queries:
+         res = conn.execute(query)
+         for rec in self.__load_details(conn, (dict(row) for row in res)):
+           rec["version"] = version
+           yield rec
+
+   @__writes
+   def __purge_version(self, source, version):
+     with self.lock, self.engine.begin() as conn:
+       conn.execute(self.inventory_table.delete().where(
+             (self.inventory_table.c.version == version) &
+                (self.inventory_table.c.source == source)
+         ))
+
+   def cleanup(self, days = None, keep = None, sources = None):
+     """Prune versions older than days, always keeping the last keep (successful) versions.
+
+     Either limit may be None, versions grow with time so everything up to the
+     newest prunable version of a source is deleted. sources limits pruning to
+     the given sources (default: all).
+     """
+     if days is None and keep is None:
        return False
 
-     # store data
-     with self.engine.begin() as conn:
-       conn.execute(self.source_table.insert(), sources_save)
-       conn.execute(self.inventory_table.insert(), data)
+     prunable = {}
+     with self.engine.connect() as conn:
+       if days is not None:
+         cutoff = datetime.utcnow() - timedelta(days = days)
+         query = (sa.select([
+                       self.source_table.c.source,
+                       sa.func.max(self.source_table.c.version).label("version")])
+                   .where(self.source_table.c.created_at <= cutoff)
+                   .group_by(self.source_table.c.source))
+         if sources is not None:
+           query = query.where(self.source_table.c.source.in_(sources))
+         for row in conn.execute(query):
+           prunable[row["source"]] = row["version"]
+       else:
+         # up to the last successful version, versions being written are not in ci_source yet
+         query = (sa.select([
+                       self.source_table.c.source,
+                       sa.func.max(self.source_table.c.version).label("version")])
+                   .where(self.source_table.c.status == STATUS_OK)
+                   .group_by(self.source_table.c.source))
+         if sources is not None:
+           query = query.where(self.source_table.c.source.in_(sources))
+         res = conn.execute(query)
+         for row in res:
+           prunable[row["source"]] = row["version"]
+
+       if keep is not None and keep > 0:
+         for source in prunable.keys():
+           kept = [row[0] for row in conn.execute(sa.select([self.source_table.c.version])
+                     .where((self.source_table.c.source == source) &
+                              (self.source_table.c.status == STATUS_OK))
+                     .order_by(self.source_table.c.version.desc())
+                     .limit(keep))]
+           if kept:
+             prunable[source] = min(prunable[source], min(kept) - 1)
+
+     pruned = False
+     for source, version in prunable.items():
+       if version > 0:
+         self.__prune_source(source, version)
+         pruned = True
+
+     if pruned:
+       self.__prune_details()
      return True
 
-   def cleanup(self, days):
-     res = self.conn.execute(sa.select([
-                   self.source_table.c.source,
-                   self.source_table.c.version])
-		.where(self.source_table.c.ts <= datetime.today() - timedelta(days=days)))
-     res = res.fetchall()
+   @__writes
+   def __prune_details(self):
+     # details no longer referenced by any record
+     details = self.details_table
+     referenced = [sa.exists().where(table.c.details_hash == details.c.hash)
+                     for table in [self.inventory_table, self.entity_table, self.entity_history_table]]
+     with self.lock, self.engine.begin() as conn:
+       conn.execute(details.delete().where(sa.not_(sa.or_(*referenced))))
 
-     with self.engine.begin() as conn:
-       for row in res:
-         logging.debug("prune: source={}, version={}".format(row["source"], row["version"]))
+   @__writes
+   def __prune_source(self, source, version_max):
+     batch_versions = self.config.get("prune_batch_versions", PRUNE_BATCH_VERSIONS)
+
+     # batches are delimited by stored versions, gaps (failed runs) fall into them
+     with self.engine.connect() as conn:
+       versions = [row[0] for row in conn.execute(sa.select([self.source_table.c.version])
+                     .where((self.source_table.c.source == source) &
+                              (self.source_table.c.version <= version_max))
+                     .order_by(self.source_table.c.version))]
+     if not versions or versions[-1] != version_max:
+       versions.append(version_max)
+
+     for idx in range(batch_versions - 1, len(versions) + batch_versions - 1, batch_versions):
+       upto = versions[min(idx, len(versions) - 1)]
+       logging.debug("prune: source={}, version<={}".format(source, upto))
+       with self.lock, self.engine.begin() as conn:
          conn.execute(self.inventory_table.delete().where(
-               (self.inventory_table.c.source == row["source"]) &
-                  (self.inventory_table.c.version == row["version"])
+               (self.inventory_table.c.source == source) &
+                  (self.inventory_table.c.version_last <= upto)
+           ))
+         conn.execute(self.entity_history_table.delete().where(
+               (self.entity_history_table.c.source == source) &
+                  (self.entity_history_table.c.version_to <= upto)
            ))
          conn.execute(self.source_table.delete().where(
-               (self.source_table.c.source == row["source"]) &
-                  (self.source_table.c.version == row["version"])
+               (self.source_table.c.source == source) &
+                  (self.source_table.c.version <= upto)
            ))
-     return True
 
    def disconnect(self):
-     self.conn.invalidate()
-     self.conn.close()
-     self.conn = None
+     # connections are returned to the pool after each operation, nothing to release
+     return True
+
+   def close(self):
+     if self.writer:
+       self.writer.shutdown()
+       self.writer = None
+     if self.engine:
+       self.engine.dispose()
+       self.engine = None
      return True
@@ -0,0 +1,288 @@
+"""Storage writer process, collector workers stream records to it over a queue."""
+import logging, threading, queue, itertools, traceback
+import multiprocessing
+import concurrent.futures
+
+from cloudinventario.storage import InventoryStorage, BATCH_SIZE
+
+QUEUE_SIZE = 64
+FEED_SIZE = 4
+
+# seconds between liveness checks of blocked queue operations
+POLL_INTERVAL = 1
+# seconds a save waits for the next records of its client (client died)
+FEED_TIMEOUT = 3600
+# seconds stop() waits for the writer process before terminating it
+STOP_TIMEOUT = 60
+
+# client of the writer attached to this process (see attach())
+_client = None
+
+def attach(writer):
+   """Use the writer for storage operations of this process (i.e. as a worker initializer)."""
+   global _client
+   _client = writer.client()
+
+def attached():
+   return _client
+
+class _Abort(Exception):
+   pass
+
+class WriterDied(Exception):
+   pass
+
+class StorageWriter:
+   """Writer process, owns the only storage (and DB connection) of the run.
+
+   Workers send record batches, the writer process writes them (one writer
+   thread, see InventoryStorage single_writer) while workers keep fetching.
+   """
+
+   def __init__(self, config, clients = 1):
+     self.config = config
+     ctx = multiprocessing.get_context()
+     self.requests = ctx.Queue(config.get("writer_queue_size", QUEUE_SIZE))
+     self.replies = [ctx.Queue() for idx in range(clients)]
+     self.slots = ctx.Value('i', 0)
+     # the writer holds the only write end, readers see EOF once it exits (any process can poll it)
+     self.alive, alive_w = ctx.Pipe(duplex = False)
+     self.process = ctx.Process(target = _serve, name = "storage-writer",
+                                 args = (config, self.requests, self.replies, alive_w))
+     self.__alive_w = alive_w
+
+   def start(self):
+     self.process.start()
+     self.__alive_w.close()
+
+   def stop(self, timeout = None):
+     timeout = self.config.get("writer_stop_timeout", STOP_TIMEOUT) if timeout is None else timeout
+     # open saves are aborted (and their versions purged) by the writer
+     try:
+       _put(self.requests, ("stop", None, None, None), self.process.is_alive)
+     except WriterDied:
+       pass
+     self.process.join(timeout)
+     if self.process.is_alive():
+       logging.error("storage writer did not stop in {}s, terminating it".format(timeout))
+       self.process.terminate()
+       self.process.join()
+     return self.process.exitcode == 0
+
+   def client(self):
+     # each process gets its own reply queue
+     with self.slots.get_lock():
+       slot = self.slots.value
+       self.slots.value += 1
+     if slot >= len(self.replies):
+       raise Exception("No free storage writer slot (clients={})".format(len(self.replies)))
+     return WriterClient(self.config, self.requests, self.replies[slot], slot, self.alive)
+
+def _put(items, item, alive):
+   # put to a bounded queue, giving up once its consumer is gone
+   while True:
+     try:
+       items.put(item, timeout = POLL_INTERVAL)
+       return
+     except queue.Full:
+       if not alive():
+         raise WriterDied("storage writer exited")
+
+class WriterClient:
+   """Storage interface (connect/save/log_status) forwarding to the writer process."""
+
+   def __init__(self, config, requests, replies, slot, alive):
+     self.config = config
+     self.requests = requests
+     self.replies = replies
+     self.slot = slot
+     self.alive = alive
+     self.ids = itertools.count()
+     self.lock = threading.Lock()
+     self.pending = {}
+     self.receiver = None
+     self.died = False
+
+   def connect(self):
+     return True
+
+   def disconnect(self):
+     return True
+
+   def close(self):
+     return True
+
+   def __writer_alive(self):
+     # EOF (poll() is True) once the writer process exited, it never sends anything
+     if not self.died and self.alive.poll():
+       self.died = True
+     return not self.died
+
+   def __request(self, op, req_id, payload = None):
+     if not self.__writer_alive():
+       raise WriterDied("storage writer exited")
+     _put(self.requests, (op, self.slot, req_id, payload), self.__writer_alive)
+
+   def __expect(self, req_id):
+     future = concurrent.futures.Future()
+     with self.lock:
+       if not self.__writer_alive():
+         raise WriterDied("storage writer exited")
+       self.pending[req_id] = future
+       if self.receiver is None:
+         self.receiver = threading.Thread(target = self.__receive, name = "storage-writer-replies", daemon = True)
+         self.receiver.start()
+     return future
+
+   def __receive(self):
+     # replies of concurrent requests (threads) share the queue
+     while True:
+       try:
+         req_id, ok, result = self.replies.get(timeout = POLL_INTERVAL)
+       except queue.Empty:
+         if self.__writer_alive():
+           continue
+         # writer died, nobody will answer the pending requests
+         with self.lock:
+           pending = list(self.pending.values())
+           self.pending.clear()
+           self.receiver = None
+         for future in pending:
+           future.set_exception(WriterDied("storage writer exited"))
+         return
+
+       with self.lock:
+         future = self.pending.pop(req_id)
+       if ok:
+         future.set_result(result)
+       else:
+         future.set_exception(Exception("storage writer failed: {}".format(result)))
+
+   def save(self, data, runtime = None):
+     if data is None:
+       return False
+
+     batch_size = self.config.get("batch_size", BATCH_SIZE)
+     req_id = next(self.ids)
+     future = self.__expect(req_id)
+     try:
+       batch = []
+       for rec in data:
+         batch.append(rec)
+         if len(batch) >= batch_size:
+           self.__request("records", req_id, batch)
+           batch = []
+       if len(batch) > 0:
+         self.__request("records", req_id, batch)
+     except Exception:
+       try:
+         self.__request("abort", req_id)
+         future.result()
+       except Exception:
+         pass
+       raise
+
+     # runtime is known only after the data were consumed
+     if callable(runtime):
+       runtime = runtime()
+     self.__request("end", req_id, runtime)
+     return future.result()
+
+   def log_status(self, source, status, runtime = None, error = None):
+     req_id = next(self.ids)
+     future = self.__expect(req_id)
+     self.__request("status", req_id, (source, status, runtime, error))
+     return future.result()
+
+def _serve(config, requests, replies, alive_w):
+   config = dict(config)
+   config["single_writer"] = True
+   storage = InventoryStorage(config)
+   storage.connect()
+
+   feeds = {}
+   savers = []
+
+   def reply(slot, req_id, ok, result):
+     replies[slot].put((req_id, ok, result))
+
+   def save(slot, req_id, feed):
+     runtime = [None]
+     done = [False]
+
+     def next_item():
+       try:
+         return feed.get(timeout = feed_timeout)
+       except queue.Empty:
+         # client is gone without ending its save
+         logging.error("storage writer got no data of slot={}, request={} for {}s, aborting".format(slot, req_id, feed_timeout))
+         return None
+
+     def records():
+       while True:
+         item = next_item()
+         if item is None:
+           done[0] = True
+           raise _Abort()
+         if isinstance(item, tuple):
+           done[0] = True
+           runtime[0] = item[1]
+           return
+         yield from item
+
+     try:
+       reply(slot, req_id, True, storage.save(records(), lambda: runtime[0]))
+     except _Abort:
+       reply(slot, req_id, False, "aborted")
+     except Exception as e:
+       logging.error("storage writer failed to save data", exc_info = e)
+       reply(slot, req_id, False, traceback.format_exc())
+       # drain the rest of the request
+       while not done[0]:
+         item = next_item()
+         done[0] = item is None or isinstance(item, tuple)
+
+   def feed(slot, req_id, item):
+     key = (slot, req_id)
+     if key not in feeds:
+       items = queue.Queue(FEED_SIZE)
+       saver = threading.Thread(target = save, args = (slot, req_id, items), name = "saver-{}-{}".format(slot, req_id))
+       saver.start()
+       savers.append(saver)
+       feeds[key] = (items, saver)
+     # data of a save that gave up (timeout) are dropped
+     items, saver = feeds[key]
+     try:
+       _put(items, item, saver.is_alive)
+     except WriterDied:
+       pass
+
+   feed_timeout = config.get("writer_feed_timeout", FEED_TIMEOUT)
+   while True:
+     op, slot, req_id, payload = requests.get()
+     if op == "stop":
+       # saves not ended by their clients are aborted (the storage purges their versions)
+       for key in list(feeds.keys()):
+         feed(*key, None)
+       feeds.clear()
+       break
+     elif op == "records":
+       feed(slot, req_id, payload)
+     elif op == "end":
+       # end marker is a tuple, empty saves still get their reply
+       feed(slot, req_id, ("end", payload))
+       feeds.pop((slot, req_id))
+     elif op == "abort":
+       feed(slot, req_id, None)
+       feeds.pop((slot, req_id))
+     elif op == "status":
+       try:
+         reply(slot, req_id, True, storage.log_status(*payload))
+       except Exception as e:
+         logging.error("storage writer failed to log status", exc_info = e)
+         reply(slot, req_id, False, traceback.format_exc())
+
+   for saver in savers:
+     saver.join()
+   storage.close()
+   alive_w.close()
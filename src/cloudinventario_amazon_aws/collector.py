@@ -1,10 +1,12 @@
 import concurrent.futures
-import logging, re, sys, asyncio, time
+import logging, re, sys, asyncio, time, threading
 from pprint import pprint
 
-import boto3
+from cloudinventario.helpers import CloudCollector, CloudInvetarioResourceManager, lazy_import
+import cloudinventario_amazon_aws.instance_types as instance_types
+from cloudinventario_amazon_aws.tags import TagProvider
 
-from cloudinventario.helpers import CloudCollector, CloudInvetarioResourceManager
+boto3 = lazy_import("boto3")
 
 # TEST MODE
 TEST = 0
@@ -16,6 +18,10 @@ class CloudCollectorAmazonAWS(CloudCollector):
 
   def __init__(self, name, config, defaults, options):
     super().__init__(name, config, defaults, options)
+    self.tag_provider = False
+    self.tag_providers = {}
+    self.clients = {}
+    self.lock = threading.Lock()
 
   def _config_keys():
     return {
@@ -40,54 +46,77 @@ class CloudCollectorAmazonAWS(CloudCollector):
       logging.getLogger(logger).propagate = False
       logging.getLogger(logger).setLevel(logging.WARNING)
 
+    # own session, collectors may log in concurrently (aws-multi) and the default one is not thread safe
+    self.session = boto3.Session(aws_access_key_id = access_key, aws_secret_access_key = secret_key,
+                                  aws_session_token = session_token, region_name = region)
+    self.clients = {}
     if self.account_id is None:
-      sts = boto3.client('sts', aws_access_key_id = access_key, aws_secret_access_key = secret_key)
+      sts = self.get_client('sts')
       ident = sts.get_caller_identity()
       self.account_id = ident['Account']
 
     logging.info("logging in AWS account_id={}, region={}".format(self.account_id, region))
-    self.session = boto3.Session(aws_access_key_id = access_key, aws_secret_access_key = secret_key,
-                                  aws_session_token = session_token, region_name = region)
-    self.client = self.session.client('ec2')
+    self.client = self.get_client('ec2')
 
-    self.instance_types = {}
+    # catalog of the region is shared by all collectors of the process and cached between runs
+    self.instance_types_cache = self.config.get('instance_types_cache', instance_types.CACHE_DIR)
+    self.instance_types_ttl = self.config.get('instance_types_ttl', instance_types.CACHE_TTL)
+
+    # tags of resources by bulk GetResources calls (per region) instead of a call per resource
+    self.tag_provider = self.config.get('tag_provider', False)
+    self.tag_providers = {}
+    try:
+      self.partition = self.session.get_partition_for_region(region)
+    except Exception:
+      self.partition = "aws"
 
     return self.session
 
   def _fetch(self, collect):
-    data = []
-
     next_token = ""
     while True:
       instances = self.client.describe_instances(MaxResults=100, NextToken=next_token)
 
       for reservations in instances['Reservations']:
         for instance in reservations['Instances']:
-          data.append(self._process_vm(instance))
+          yield self._process_vm(instance)
 
       next_token = None
       if 'NextToken' in instances:
          next_token = instances['NextToken']
       if not next_token:
         break
-    return data
 
   def _get_instance_type(self, itype):
-    if itype not in self.instance_types:
-      types = self.client.describe_instance_types(InstanceTypes = [ itype ])
-      for rec in types['InstanceTypes']:
-        name = rec['InstanceType']
-        data = {
-          "cpu": rec['VCpuInfo']['DefaultVCpus'],
-          "memory": rec['MemoryInfo']['SizeInMiB']
-        }
-        data['details'] = rec
-        self.instance_types[name] = data
-
-    if itype not in self.instance_types:
-      raise Exception("Instance type '{}' not found".format(itype))
-
-    return self.instance_types[itype]
+    return instance_types.get_type(self.client, self.region, itype,
+                                   self.instance_types_cache, self.instance_types_ttl)
+
+  def get_client(self, service, region = None):
+    """Client of the session (default region if None), shared by the collector and its resources.
+
+    Sessions are not thread safe (clients are), all clients are created here under the lock.
+    """
+    with self.lock:
+      if (service, region) not in self.clients:
+        if region:
+          self.clients[(service, region)] = self.session.client(service, region_name = region)
+        else:
+          self.clients[(service, region)] = self.session.client(service)
+      return self.clients[(service, region)]
+
+  def get_tag_provider(self, region = None):
+    """TagProvider of the region (None if disabled)."""
+    if not self.tag_provider:
+      return None
+    region = region or self.region
+    client = self.get_client('resourcegroupstaggingapi', region)
+    with self.lock:
+      if region not in self.tag_providers:
+        self.tag_providers[region] = TagProvider(client, self.config.get('tag_provider_types'))
+      return self.tag_providers[region]
+
+  def get_arn(self, service, resource, region = None, account_id = None):
+    return "arn:{}:{}:{}:{}:{}".format(self.partition, service, region or "", account_id or "", resource)
 
   def _get_tags(self, data, tag_key="Tags"):
     tags = {}
@@ -122,26 +151,12 @@ class CloudCollectorAmazonAWS(CloudCollector):
           "connected": True
         })
 
-    # TODO: avoid duplicate counting
-    storage = 0
-    storages = []
-    ebs_data = self.get_resource_data("ebs")
-    if ebs_data and rec["InstanceId"] in ebs_data:
-      storage = ebs_data[rec["InstanceId"]]["size"]
-      storages = ebs_data[rec["InstanceId"]]["storages"]
-
     name = tags.get("Name") or rec["InstanceId"]
     logging.debug("new VM name={}".format(name))
 
-    ebs = self.resource_collectors["ebs"].get_raw_data()
-
-    storage = 0
-    storages = []
-    for volume in ebs:
-      # XXX: only count storage size on one instance
-      if volume["mounts"] and rec["InstanceId"] == volume["mounts"][0]:
-        storage += volume["storage"]
-        storages.append(volume)
+    # XXX: only count storage size on one instance
+    storages = list(self.resource_collectors["ebs"].lookup("instance", rec["InstanceId"]))
+    storage = sum([volume["storage"] for volume in storages])
 
     vm_data = {
         "created": None,
@@ -153,7 +168,7 @@ class CloudCollectorAmazonAWS(CloudCollector):
         "type": instance_type,
         "cpus": rec["CpuOptions"]["CoreCount"] or instance_def["cpu"],
         "memory": instance_def["memory"],
-        "disks": len(ebs),
+        "disks": len(storages),
         "storage": storage,
         "primary_ip":  rec.get("PrivateIpAddress") or rec.get("PublicIpAddress"),
         "primary_fqdn": rec.get("PrivateDnsName") or rec.get("PublicDnsName"),
@@ -0,0 +1,98 @@
+"""EC2 instance type catalog, fetched once per region and shared by the collectors of the process."""
+import os, json, stat, time, logging, threading
+
+# seconds a cached catalog file is used
+CACHE_TTL = 86400
+# per user, a shared (i.e. tmp) directory would let other users plant a catalog
+CACHE_DIR = os.path.join(os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"), "cloudinventario")
+
+_catalogs = {}
+_locks = {}
+_lock = threading.Lock()
+
+def _region_lock(region):
+  with _lock:
+    if region not in _locks:
+      _locks[region] = threading.Lock()
+    return _locks[region]
+
+def _type_data(rec):
+  return {
+    "cpu": rec['VCpuInfo']['DefaultVCpus'],
+    "memory": rec['MemoryInfo']['SizeInMiB'],
+    "details": rec
+  }
+
+def _cache_file(cache_dir, region):
+  return os.path.join(cache_dir, "aws-instance-types-{}.json".format(region))
+
+def _trusted(st):
+  # owned by the user and not writable by others
+  if hasattr(os, "getuid") and st.st_uid != os.getuid():
+    return False
+  return not st.st_mode & (stat.S_IWGRP | stat.S_IWOTH)
+
+def _load(path, ttl):
+  try:
+    st = os.stat(path)
+    if not _trusted(st) or not _trusted(os.stat(os.path.dirname(path))):
+      logging.warning("ignoring instance types cache={}, not owned by the user or writable by others".format(path))
+      return None
+    if time.time() - st.st_mtime > ttl:
+      return None
+    with open(path) as f:
+      return json.load(f)
+  except (OSError, ValueError) as e:
+    if os.path.exists(path):
+      logging.warning("failed to read instance types cache={}, reason: {}".format(path, e))
+    return None
+
+def _save(path, catalog):
+  try:
+    os.makedirs(os.path.dirname(path), mode = 0o700, exist_ok = True)
+    tmp = "{}.{}.tmp".format(path, os.getpid())
+    with open(tmp, "w") as f:
+      json.dump(catalog, f, default = str)
+    os.replace(tmp, path)
+  except OSError as e:
+    logging.warning("failed to write instance types cache={}, reason: {}".format(path, e))
+
+def _fetch(client):
+  catalog = {}
+  paginator = client.get_paginator('describe_instance_types')
+  for page in paginator.paginate(PaginationConfig = { "PageSize": 100 }):
+    for rec in page['InstanceTypes']:
+      catalog[rec['InstanceType']] = _type_data(rec)
+  return catalog
+
+def get_catalog(client, region, cache_dir = CACHE_DIR, ttl = CACHE_TTL):
+  """Instance types of the region {type: {cpu, memory, details}}, from memory, cache file or EC2."""
+  with _region_lock(region):
+    if region not in _catalogs:
+      path = _cache_file(cache_dir, region) if cache_dir else None
+      catalog = _load(path, ttl) if path else None
+      if catalog is None:
+        start = time.time()
+        catalog = _fetch(client)
+        logging.info("fetched instance types region={}, types={}, runtime={:.2f}s".format(region, len(catalog), time.time() - start))
+        if path:
+          _save(path, catalog)
+      _catalogs[region] = catalog
+    return _catalogs[region]
+
+def get_type(client, region, itype, cache_dir = CACHE_DIR, ttl = CACHE_TTL):
+  catalog = get_catalog(client, region, cache_dir, ttl)
+  if itype not in catalog:
+    # type newer than the cached catalog
+    with _region_lock(region):
+      types = client.describe_instance_types(InstanceTypes = [ itype ])
+      for rec in types['InstanceTypes']:
+        catalog[rec['InstanceType']] = _type_data(rec)
+
+  if itype not in catalog:
+    raise Exception("Instance type '{}' not found".format(itype))
+  return catalog[itype]
+
+def clear():
+  with _lock:
+    _catalogs.clear()
@@ -1,4 +1,3 @@
-import boto3
 
 from cloudinventario.helpers import CloudInvetarioResource
 
@@ -6,6 +5,10 @@ def setup(resource, collector):
   return CloudInventarioEbs(resource, collector)
 
 class CloudInventarioEbs(CloudInvetarioResource):
+  # XXX: storage is counted on the first instance only
+  INDEXES = {
+    "instance": lambda volume: volume["mounts"][:1]
+  }
 
   def __init__(self, resource, collector):
     super().__init__(resource, collector)
@@ -15,7 +18,7 @@ class CloudInventarioEbs(CloudInvetarioResource):
     self.client = self.get_client()
 
   def _get_client(self):
-    client = self.session.client('ec2')
+    client = self.collector.get_client('ec2')
     return client
 
   def _fetch(self):
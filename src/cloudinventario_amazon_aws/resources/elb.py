@@ -1,4 +1,4 @@
-import boto3, json
+import json
 from pprint import pprint
 
 from cloudinventario.helpers import CloudInvetarioResource
@@ -16,19 +16,16 @@ class CloudInventarioElb(CloudInvetarioResource):
     self.client = self.get_client()
 
   def _get_client(self):
-    client = self.session.client('elb')
+    client = self.collector.get_client('elb')
     return client
 
   def _fetch(self):
-    data = []
     paginator = self.client.get_paginator('describe_load_balancers')
     response_iterator = paginator.paginate()
 
     for page in response_iterator:
       for lb in page['LoadBalancerDescriptions']:
-        data.append(self.process_resource(lb))
-
-    return data
+        yield self.process_resource(lb)
 
   def _process_resource(self, balancer):
     health_info = self.client.describe_instance_health(LoadBalancerName=balancer['LoadBalancerName'])
@@ -48,9 +45,15 @@ class CloudInventarioElb(CloudInvetarioResource):
         "state": instance['State']
       }
 
-    tags_data = self.client.describe_tags(LoadBalancerNames=[
-      balancer.get('LoadBalancerName', "")
-      ])
+    provider = self.collector.get_tag_provider()
+    if provider and provider.available():
+      arn = self.collector.get_arn("elasticloadbalancing", "loadbalancer/" + balancer['LoadBalancerName'],
+                                   self.collector.region, self.collector.account_id)
+      tags_data = { "TagDescriptions": [{ "LoadBalancerName": balancer['LoadBalancerName'], "Tags": provider.get(arn, []) }] }
+    else:
+      tags_data = self.client.describe_tags(LoadBalancerNames=[
+        balancer.get('LoadBalancerName', "")
+        ])
     balancer.update(tags_data)
     tags = self.collector._get_tags(tags_data['TagDescriptions'][0])
 
@@ -1,4 +1,4 @@
-import boto3, json
+import json
 from pprint import pprint
 
 from cloudinventario.helpers import CloudInvetarioResource
@@ -16,19 +16,16 @@ class CloudInventarioRds(CloudInvetarioResource):
     self.client = self.get_client()
 
   def _get_client(self):
-    client = self.session.client('rds')
+    client = self.collector.get_client('rds')
     return client
 
   def _fetch(self):
-    data = []
     paginator = self.client.get_paginator('describe_db_instances')
     response_iterator = paginator.paginate()
 
     for page in response_iterator:
       for db_instance in page['DBInstances']:
-        data.append(self.process_resource(db_instance))
-
-    return data
+        yield self.process_resource(db_instance)
 
   def _process_resource(self, db):
     storage = db['PendingModifiedValues'].get('AllocatedStorage') or db['AllocatedStorage']
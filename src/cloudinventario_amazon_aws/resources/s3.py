@@ -1,5 +1,6 @@
 import logging
-import boto3, json
+import json
+import concurrent.futures
 from pprint import pprint
 
 from cloudinventario.helpers import CloudInvetarioResource
@@ -7,103 +8,111 @@ from cloudinventario.helpers import CloudInvetarioResource
 def setup(resource, collector):
   return CloudInventarioS3(resource, collector)
 
+# per bucket sub-calls: name -> (client method, response key, message when it fails)
+CALLS = {
+  "acl": ("get_bucket_acl", None, "The acl of the following bucket was not found: {}, you need the \"READ_ACP\" permission"),
+  "location": ("get_bucket_location", None, "The acl of the following bucket was not found: {}, you must be owner"),
+  "ownership_controls": ("get_bucket_ownership_controls", "OwnershipControls", "The ownership controls of the following bucket were not found: {}, you need the \"S3:GetBucketOwnershipControls\" permission"),
+  "policy_status": ("get_bucket_policy_status", "PolicyStatus", "The acl of the following bucket was not found: {}, you need the \"S3:GetBucketPolicyStatus\" permission"),
+  "website": ("get_bucket_website", None, "The website of the following bucket was not found: {}, you need the \"S3:GetBucketWebsite\" permission"),
+  "versioning": ("get_bucket_versioning", None, "The acl of the following bucket was not found: {}, you must be owner"),
+  "tags": ("get_bucket_tagging", None, "The tags of the following bucket were not found: {}, you need the \"s3:GetBucketTagging\" permission")
+}
+
+# concurrent sub-calls (across buckets)
+WORKERS = 8
+
 class CloudInventarioS3(CloudInvetarioResource):
 
   def __init__(self, resource, collector):
     super().__init__(resource, collector)
+    self.workers = collector.config.get('s3_workers', WORKERS)
+    self.calls = [call for call in CALLS.keys() if call in collector.config.get('s3_calls', CALLS.keys())]
 
   def _login(self, session):
     self.session = session
     self.client = self.get_client()
 
   def _get_client(self):
-    client = self.session.client('s3')
+    client = self.collector.get_client('s3')
     return client
 
-  def _fetch(self):
-    data = []
-
-    for bucket in self.client.list_buckets()['Buckets']:
-      data.append(self._process_resource(bucket['Name']))
+  def _get_region(self, location):
+    # no location is us-east-1, EU is the legacy eu-west-1
+    return { None: "us-east-1", "": "us-east-1", "EU": "eu-west-1" }.get(location, location)
 
-    return data
+  def _get_location_client(self, region):
+    # buckets are served by their region
+    return self.collector.get_client('s3', region)
 
-  def _process_resource(self, bucket_name):
-    details = {}
-
-    try: # acl
-      acl = self.client.get_bucket_acl(Bucket=bucket_name)
-      acl.pop("ResponseMetadata", None)
-      details["acl"] = acl
-      owner_id = acl['Owner']['ID']
-      acl = acl['Grants']
-    except Exception:
-      owner_id = None
-      acl = None
-      logging.info("The acl of the following bucket was not found: {}, you need the \"READ_ACP\" permission".format(bucket_name))
-
-    try: # location
-      location = self.client.get_bucket_location(Bucket=bucket_name)
-      location.pop("ResponseMetadata", None)
-      details["location"] = location
-      location = location['LocationConstraint']
+  def _call(self, client, call, bucket_name):
+    method, key, message = CALLS[call]
+    try:
+      res = getattr(client, method)(Bucket=bucket_name)
+      res.pop("ResponseMetadata", None)
+      return res[key] if key else res
     except Exception:
-      location = None
-      logging.info("The acl of the following bucket was not found: {}, you must be owner".format(bucket_name))
+      logging.info(message.format(bucket_name))
+      return None
 
-    try: # ownership controls
-      ownership_controls = self.client.get_bucket_ownership_controls(Bucket=bucket_name)['OwnershipControls']
-      ownership_controls.pop("ResponseMetadata", None)
-      details["ownership_controls"] = ownership_controls
-    except Exception:
-      ownership_controls = None
-      logging.info("The ownership controls of the following bucket were not found: {}, you need the \"S3:GetBucketOwnershipControls\" permission".format(bucket_name))
+  def _get_provider_tags(self, client, bucket_name, region):
+    provider = self.collector.get_tag_provider(region)
+    if not provider.available():
+      return self._call(client, "tags", bucket_name)
+    tags = provider.get(self.collector.get_arn("s3", bucket_name))
+    return { "TagSet": tags } if tags else None
 
-    try: # policy status
-      policy_status = self.client.get_bucket_policy_status(Bucket=bucket_name)['PolicyStatus']
-      policy_status.pop("ResponseMetadata", None)
-      details["policy_status"] = policy_status
-    except Exception:
-      policy_status = None
-      logging.info("The acl of the following bucket was not found: {}, you need the \"S3:GetBucketPolicyStatus\" permission".format(bucket_name))
-
-    try: # website
-      website = self.client.get_bucket_website(Bucket=bucket_name)
-      website.pop("ResponseMetadata", None)
-      details["website"] = website
-    except Exception:
-      website = None
-      logging.info("The website of the following bucket was not found: {}, you need the \"S3:GetBucketWebsite\" permission".format(bucket_name))
-
-    try: # versioning
-      versioning = self.client.get_bucket_versioning(Bucket=bucket_name)
-      versioning.pop("ResponseMetadata", None)
-      details["versioning"] = versioning
-      versioning = versioning['Status']
-    except Exception:
-      versioning = None
-      logging.info("The acl of the following bucket was not found: {}, you must be owner".format(bucket_name))
-
-    try: # tags
-      tags = self.client.get_bucket_tagging(Bucket=bucket_name)
-      tags.pop('ResponseMetadata', None)
-      details["tags"] = tags
-      tags = self.collector._get_tags(tags, 'TagSet')
-    except Exception:
-      tags = None
-      logging.info("The tags of the following bucket were not found: {}, you need the \"s3:GetBucketTagging\" permission".format(bucket_name))
+  def _fetch(self):
+    buckets = [bucket['Name'] for bucket in self.client.list_buckets()['Buckets']]
+    calls = [call for call in self.calls if call != "location"]
+    provider_tags = "tags" in calls and self.collector.get_tag_provider() is not None
+    if provider_tags:
+      calls.remove("tags")
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers = self.workers, thread_name_prefix = "s3") as executor:
+      # location first, the other calls use the client of the bucket region
+      locations = [None] * len(buckets)
+      if "location" in self.calls:
+        locations = list(executor.map(lambda bucket_name: self._call(self.client, "location", bucket_name), buckets))
+
+      pending = []
+      for bucket_name, location in zip(buckets, locations):
+        region = self._get_region(location.get('LocationConstraint')) if location else None
+        client = self._get_location_client(region) if region else self.client
+        futures = { call: executor.submit(self._call, client, call, bucket_name) for call in calls }
+        if provider_tags:
+          futures["tags"] = executor.submit(self._get_provider_tags, client, bucket_name, region)
+        pending.append((bucket_name, location, futures))
+
+      # records in the order of buckets
+      for bucket_name, location, futures in pending:
+        results = { call: future.result() for call, future in futures.items() }
+        if "location" in self.calls:
+          results["location"] = location
+        yield self._process_resource(bucket_name, results)
+
+  def _process_resource(self, bucket_name, results = None):
+    if results is None:
+      results = { call: self._call(self.client, call, bucket_name) for call in self.calls }
+    details = { call: res for call, res in results.items() if res is not None }
+
+    acl = results.get("acl")
+    owner_id = acl['Owner']['ID'] if acl else None
+    location = results.get("location")
+    versioning = results.get("versioning")
+    tags = results.get("tags")
 
     data = {
-      "acl": acl,
-      "location": location,
-      "ownership_controls": ownership_controls,
-      "policy_status": policy_status,
-      "versioning": versioning,
-      "website": website,
+      "acl": acl['Grants'] if acl else None,
+      "location": location.get('LocationConstraint') if location else None,
+      "ownership_controls": results.get("ownership_controls"),
+      "policy_status": results.get("policy_status"),
+      "versioning": versioning.get('Status') if versioning else None,
+      "website": results.get("website"),
       "name": bucket_name,
       "id": bucket_name,
       "owner": owner_id,
-      "tags": tags
+      "tags": self.collector._get_tags(tags, 'TagSet') if tags else None
     }
 
     return self.new_record(self.res_type, data, details)
@@ -0,0 +1,47 @@
+"""Tags of an account/region from the Resource Groups Tagging API, indexed by ARN."""
+import time, logging, threading
+
+# resource types the resources of the collector look up (ResourceTypeFilters)
+RESOURCE_TYPES = ["s3", "elasticloadbalancing:loadbalancer"]
+
+class TagProvider:
+  """All tags of a region loaded by paginated GetResources calls on first use.
+
+  The client is a 'resourcegroupstaggingapi' client (any object with the same
+  paginator, i.e. a mocked one).
+  """
+
+  def __init__(self, client, resource_types = None):
+    self.client = client
+    self.resource_types = RESOURCE_TYPES if resource_types is None else resource_types
+    self.tags = None
+    self.error = None
+    self.lock = threading.Lock()
+
+  def load(self):
+    start = time.time()
+    tags = {}
+    paginator = self.client.get_paginator('get_resources')
+    for page in paginator.paginate(ResourceTypeFilters = self.resource_types, ResourcesPerPage = 100):
+      for res in page['ResourceTagMappingList']:
+        tags[res['ResourceARN']] = res.get('Tags', [])
+    logging.info("fetched tags of resources={}, runtime={:.2f}s".format(len(tags), time.time() - start))
+    return tags
+
+  def available(self):
+    """Load the tags on first use, False if that failed (i.e. no tag:GetResources permission)."""
+    with self.lock:
+      # a failure is not retried, callers fall back to the per resource calls
+      if self.tags is None and self.error is None:
+        try:
+          self.tags = self.load()
+        except Exception as e:
+          self.error = e
+          logging.error("Failed to fetch tags of resources, falling back to per resource calls, reason: {}".format(e))
+    return self.error is None
+
+  def get(self, arn, default = None):
+    """Tags of the ARN [{Key, Value}], default for resources never tagged (or if the tags are not available)."""
+    if not self.available():
+      return default
+    return self.tags.get(arn, default)
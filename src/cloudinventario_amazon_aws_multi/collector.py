@@ -1,18 +1,22 @@
 import concurrent.futures
-import logging, re, sys, asyncio, time
+import logging, re, sys, asyncio, time, threading
 from pprint import pprint
 
-import boto3
-import boto3.session
-from botocore.exceptions import ClientError
-
 from cloudinventario.cloudinventario import CloudInventario
-from cloudinventario.helpers import CloudCollector
+from cloudinventario.helpers import CloudCollector, iter_graph, lazy_import
 #from cloudinventario_amazon_aws.collector import CloudCollectorAmazonAWS
 
+boto3 = lazy_import("boto3")
+botocore_exceptions = lazy_import("botocore.exceptions")
+
 # TEST MODE
 TEST = 0
 
+# config of the amazon-aws collectors (handles) taken from the multi config
+HANDLE_CONFIG = ["tag_provider", "tag_provider_types", "s3_workers", "s3_calls",
+                 "instance_types_cache", "instance_types_ttl",
+                 "details", "resource_workers", "resource_depends"]
+
 def setup(name, config, defaults, options):
   return CloudCollectorAmazonAWSMulti(name, config, defaults, options)
 
@@ -20,6 +24,7 @@ class CloudCollectorAmazonAWSMulti(CloudCollector):
 
   def __init__(self, name, config, defaults, options):
     super().__init__(name, config, defaults, options)
+    self.stats = []
 
   def _login(self):
     access_key = self.config['access_key']
@@ -29,8 +34,15 @@ class CloudCollectorAmazonAWSMulti(CloudCollector):
     regions = self.config.get('regions')
 
     self.creds = []
+    self.stats = []
     self.primary_region = region
 
+    # account/region pairs run in parallel, role assumption and login limited per account (STS throttling)
+    self.workers = self.config.get('workers', self.options.get('tasks') or 1)
+    self.account_workers = self.config.get('account_workers', 2)
+    self.account_locks = {}
+    self.lock = threading.Lock()
+
     for logger in ["boto3", "botocore", "urllib3"]:
       logging.getLogger(logger).propagate = False
       logging.getLogger(logger).setLevel(logging.WARNING)
@@ -38,42 +50,81 @@ class CloudCollectorAmazonAWSMulti(CloudCollector):
     logging.info("assuming AWS roles")
     #self._add_creds_regions(None, access_key, secret_key, None, regions)
     if roles:
-      client = boto3.client('sts', aws_access_key_id = access_key, aws_secret_access_key = secret_key)
-
-      for role in roles:
-        role_regions = role.get('region', regions)
-        assumed = client.assume_role(
-          RoleArn = "arn:aws:iam::{}:role/{}".format(role['account'], role['role']),
-          RoleSessionName = "ASSR-{}".format(role['account'])
-        )
-        as_creds = assumed['Credentials']
-        self._add_creds_regions(role['account'], as_creds['AccessKeyId'], as_creds['SecretAccessKey'], as_creds['SessionToken'], role_regions)
+      # default boto3 session is not thread safe, clients are
+      client = boto3.session.Session().client('sts', aws_access_key_id = access_key, aws_secret_access_key = secret_key)
+
+      def assume(role):
+        start = time.time()
+        with self._account_lock(role['account']):
+          assumed = client.assume_role(
+            RoleArn = "arn:aws:iam::{}:role/{}".format(role['account'], role['role']),
+            RoleSessionName = "ASSR-{}".format(role['account'])
+          )
+          as_creds = assumed['Credentials']
+          creds = self._add_creds_regions(role['account'], as_creds['AccessKeyId'], as_creds['SecretAccessKey'], as_creds['SessionToken'],
+                                          role.get('region', regions), [])
+        logging.info("assumed AWS role account={}, regions={}, runtime={:.2f}s".format(role['account'], len(creds), time.time() - start))
+        return creds
+
+      # creds keep the order of roles
+      for creds in self._map(assume, roles):
+        self.creds.extend(creds)
 
     # create clients
-    self.clients = []
-    for cred in self.creds:
+    def login(cred):
       account_id = cred['account_id'] or 0
       name = "{}@{}".format(self.name, account_id)
-      handle = CloudInventario.loadCollectorModule("amazon-aws", name, cred, self.defaults, self.options)
-      handle.login()
-      self.clients.append({
+      config = dict(cred)
+      config.update({ key: self.config[key] for key in HANDLE_CONFIG if key in self.config })
+      start = time.time()
+      with self._account_lock(account_id):
+        handle = CloudInventario.loadCollectorModule("amazon-aws", name, config, self.defaults, self.options)
+        handle.login()
+      return {
         "account_id": account_id,
-        "handle": handle
-      })
+        "region": cred['region'],
+        "handle": handle,
+        "login_time": time.time() - start
+      }
 
+    self.clients = list(self._map(login, self._interleave(self.creds)))
     return True
 
-  def _add_creds_regions(self, account_id, access_key, secret_key, session_token = None, regions = None):
+  def _interleave(self, creds):
+    # round robin over accounts, logins of one account would wait for its limit
+    seen = {}
+    order = []
+    for idx, cred in enumerate(creds):
+      rank = seen.get(cred['account_id'], 0)
+      seen[cred['account_id']] = rank + 1
+      order.append((rank, idx))
+    return [creds[idx] for rank, idx in sorted(order)]
+
+  def _account_lock(self, account_id):
+    with self.lock:
+      if account_id not in self.account_locks:
+        self.account_locks[account_id] = threading.BoundedSemaphore(self.account_workers)
+      return self.account_locks[account_id]
+
+  def _map(self, func, items):
+    if self.workers <= 1 or len(items) <= 1:
+      return map(func, items)
+    with concurrent.futures.ThreadPoolExecutor(max_workers = self.workers, thread_name_prefix = "aws-multi") as executor:
+      return list(executor.map(func, items))
+
+  def _add_creds_regions(self, account_id, access_key, secret_key, session_token = None, regions = None, creds = None):
+    creds = self.creds if creds is None else creds
     if regions:
        for region in regions:
-         self._add_creds(account_id, access_key, secret_key, session_token, region)
+         self._add_creds(account_id, access_key, secret_key, session_token, region, creds)
     else:
-      self._add_creds(account_id, access_key, secret_key)
-    return self.creds
+      self._add_creds(account_id, access_key, secret_key, session_token, None, creds)
+    return creds
 
-  def _add_creds(self, account_id, access_key, secret_key, session_token = None, region = None):
+  def _add_creds(self, account_id, access_key, secret_key, session_token = None, region = None, creds = None):
+    creds = self.creds if creds is None else creds
     if region:
-      self.creds.append({
+      creds.append({
         "access_key": access_key,
         "secret_key": secret_key,
         "session_token": session_token,
@@ -82,34 +133,58 @@ class CloudCollectorAmazonAWSMulti(CloudCollector):
       })
     else:
       # XXXX: discover enable regions using EC2 (what if other services have different enabled ?)
-      client = boto3.client('ec2', aws_access_key_id = access_key, aws_secret_access_key = secret_key,
+      client = boto3.session.Session().client('ec2', aws_access_key_id = access_key, aws_secret_access_key = secret_key,
                                aws_session_token = session_token, region_name = self.primary_region)
       try:
         region_list = client.describe_regions()
-      except ClientError as e:
+      except botocore_exceptions.ClientError as e:
         logging.error("Failed to discover enabled regions, please specify manually or grant permission")
         raise
       regions = [region['RegionName'] for region in region_list['Regions']]
       for region in regions:
-        self.creds.append({
-          access_key: access_key,
-          secret_key: secret_key,
-          session_token: session_token,
-          region: region,
-          account_id: account_id
+        creds.append({
+          "access_key": access_key,
+          "secret_key": secret_key,
+          "session_token": session_token,
+          "region": region,
+          "account_id": account_id
         })
-    return self.creds
+    return creds
 
   def _fetch(self, collect):
-    res = []
-    for client in self.clients:
+    clients = { idx: client for idx, client in enumerate(self.clients) }
+
+    def produce(idx):
+      client = clients[idx]
+      count = 0
+      start = time.time()
       try:
-        data = client['handle'].fetch(collect)
-        res.extend(data)
+        for rec in client['handle'].iter_fetch(collect):
+          count += 1
+          yield rec
       except Exception as e:
-        logging.error("Exception while processing account={}".format(client['account_id']))
+        logging.error("Exception while processing account={}, region={}".format(client['account_id'], client['region']))
         raise
-    return res
+      finally:
+        self._add_stats(client, count, time.time() - start)
+        # resources (i.e. EBS indexes) of the pair are not needed anymore
+        client['handle'] = None
+
+    # independent pairs, records are interleaved as they are fetched
+    yield from iter_graph(list(clients.keys()), {}, produce, self.workers)
+
+  def _add_stats(self, client, count, runtime):
+    stats = {
+      "account_id": client['account_id'],
+      "region": client['region'],
+      "login_time": client['login_time'],
+      "fetch_time": runtime,
+      "records": count
+    }
+    with self.lock:
+      self.stats.append(stats)
+    logging.info("fetched AWS account={}, region={}, records={}, login={:.2f}s, fetch={:.2f}s".format(
+                   stats['account_id'], stats['region'], count, stats['login_time'], runtime))
 
   def _logout(self):
     self.clients = None
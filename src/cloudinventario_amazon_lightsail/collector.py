@@ -1,8 +1,10 @@
 import logging
-import boto3
 
+from cloudinventario.helpers import lazy_import
 from cloudinventario_amazon_aws.collector import CloudCollectorAmazonAWS
 
+boto3 = lazy_import("boto3")
+
 def setup(name, config, defaults, options):
   return CloudCollectorAmazonLightsail(name, config, defaults, options)
 
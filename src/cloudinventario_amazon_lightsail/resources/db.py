@@ -1,4 +1,4 @@
-import boto3, json, logging
+import json, logging
 from pprint import pprint
 
 from cloudinventario.helpers import CloudInvetarioResource
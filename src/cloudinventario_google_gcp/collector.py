@@ -6,11 +6,10 @@ import asyncio
 import time
 from pprint import pprint
 
-from google.oauth2 import service_account
-import googleapiclient.discovery
-from google.cloud import storage
+from cloudinventario.helpers import CloudCollector, CloudInvetarioResourceManager, lazy_import
 
-from cloudinventario.helpers import CloudCollector, CloudInvetarioResourceManager
+service_account = lazy_import("google.oauth2.service_account")
+discovery = lazy_import("googleapiclient.discovery")
 
 # TEST MODE
 TEST = 0
@@ -67,7 +66,7 @@ class CloudCollectorGoogleGCP(CloudCollector):
     def _fetch(self, collect):
         data = []
         # GET compute engine
-        self.compute_engine = googleapiclient.discovery.build('compute', 'v1', credentials=self.credentials, cache_discovery=False)
+        self.compute_engine = discovery.build('compute', 'v1', credentials=self.credentials, cache_discovery=False)
         
         # GET all instances with specific project name and zone (return JSON, where data are in items)
         _instance = self.compute_engine.instances()
@@ -2,10 +2,9 @@ from pprint import pprint
 import logging
 import re
 
-from google.oauth2 import service_account
-import googleapiclient.discovery
+from cloudinventario.helpers import CloudInvetarioResource, lazy_import
 
-from cloudinventario.helpers import CloudInvetarioResource
+discovery = lazy_import("googleapiclient.discovery")
 
 def setup(resource, collector):
   return CloudInventarioCloudSQL(resource, collector)
@@ -25,7 +24,7 @@ class CloudInventarioCloudSQL(CloudInvetarioResource):
   def _fetch(self):
     data = []
     # GET sqladmin
-    _sqladmin = googleapiclient.discovery.build('sqladmin', 'v1beta4', credentials=self.credentials)
+    _sqladmin = discovery.build('sqladmin', 'v1beta4', credentials=self.credentials)
 
     # GET instances
     _instances = _sqladmin.instances()
@@ -2,10 +2,9 @@ from pprint import pprint
 import logging
 import re
 
-from google.oauth2 import service_account
-import googleapiclient.discovery
+from cloudinventario.helpers import CloudInvetarioResource, lazy_import
 
-from cloudinventario.helpers import CloudInvetarioResource
+discovery = lazy_import("googleapiclient.discovery")
 
 def setup(resource, collector):
   return CloudInventarioGclb(resource, collector)
@@ -25,7 +24,7 @@ class CloudInventarioGclb(CloudInvetarioResource):
   def _fetch(self):
     data = []
     # GET compute engine
-    _compute_engine = googleapiclient.discovery.build('compute', 'v1', credentials=self.credentials)
+    _compute_engine = discovery.build('compute', 'v1', credentials=self.credentials)
 
     # GET backend services/ info about load balancer
     _backend_services = _compute_engine.backendServices()
@@ -2,12 +2,9 @@ import json
 from pprint import pprint
 import logging
 
-from google.cloud import storage
-from google.cloud.storage import bucket
-from google.oauth2 import service_account
-import googleapiclient.discovery
+from cloudinventario.helpers import CloudInvetarioResource, lazy_import
 
-from cloudinventario.helpers import CloudInvetarioResource
+discovery = lazy_import("googleapiclient.discovery")
 
 
 def setup(resource, collector):
@@ -29,7 +26,7 @@ class CloudInventarioStorage(CloudInvetarioResource):
     def _fetch(self):
         data = []
         # GET storages
-        self.storage = googleapiclient.discovery.build('storage', 'v1', credentials=self.credentials)
+        self.storage = discovery.build('storage', 'v1', credentials=self.credentials)
 
         # GET all buckets in specific project
         _buckets = self.storage.buckets()
@@ -2,12 +2,10 @@
 import concurrent.futures
 import logging, re, sys, asyncio, time
 from pprint import pprint
-from boto3 import resources
 
-from hcloud import Client
-from httplib2 import Response
+from cloudinventario.helpers import CloudCollector, lazy_import
 
-from cloudinventario.helpers import CloudCollector
+Client = lazy_import("hcloud", "Client")
 
 # TEST MODE
 TEST = 0
@@ -1,9 +1,9 @@
 import logging
 from pprint import pprint
 
-from libcloud.compute.providers import get_driver
+from cloudinventario.helpers import CloudCollector, CloudInvetarioResourceManager, lazy_import
 
-from cloudinventario.helpers import CloudCollector, CloudInvetarioResourceManager
+get_driver = lazy_import("libcloud.compute.providers", "get_driver")
 
 # TEST MODE
 TEST = 0
@@ -1,23 +1,26 @@
+from __future__ import annotations
+
 import concurrent.futures
 from copy import Error
 import logging, re, sys, asyncio, time
 from pprint import pprint
-from typing import Dict, List
+from typing import TYPE_CHECKING, Dict, List
 import datetime
 
-from sqlalchemy.sql.sqltypes import Boolean
-
-from cloudinventario.helpers import CloudCollector
+from cloudinventario.helpers import CloudCollector, lazy_import
 
-from azure.identity import ClientSecretCredential
-from azure.mgmt.compute import ComputeManagementClient
-from azure.mgmt.resource import ResourceManagementClient, resources
-from azure.mgmt.network import NetworkManagementClient
+ClientSecretCredential = lazy_import("azure.identity", "ClientSecretCredential")
+ComputeManagementClient = lazy_import("azure.mgmt.compute", "ComputeManagementClient")
+ResourceManagementClient = lazy_import("azure.mgmt.resource", "ResourceManagementClient")
+NetworkManagementClient = lazy_import("azure.mgmt.network", "NetworkManagementClient")
 
-from azure.mgmt.compute.v2021_03_01.models._models_py3 import VirtualMachine
-from azure.mgmt.resource.resources.v2021_04_01.models._models_py3 import (
-    GenericResourceExpanded,
-)
+# annotations only
+if TYPE_CHECKING:
+    from sqlalchemy.sql.sqltypes import Boolean
+    from azure.mgmt.compute.v2021_03_01.models._models_py3 import VirtualMachine
+    from azure.mgmt.resource.resources.v2021_04_01.models._models_py3 import (
+        GenericResourceExpanded,
+    )
 
 # TEST MODE
 TEST = 0
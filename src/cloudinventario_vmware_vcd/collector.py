@@ -2,16 +2,17 @@ import concurrent.futures
 import logging, re, sys, asyncio
 from pprint import pprint
 
-import pyvcloud.vcd.client as vcd
-from pyvcloud.vcd.org import Org as vcdOrg
-from pyvcloud.vcd.vdc import VDC as vcdVDC
-from pyvcloud.vcd.vapp import VApp as vcdVApp
-from pyvcloud.vcd.vapp import VM as vcdVM
-from pyvcloud.vcd.utils import to_dict, vapp_to_dict, vm_to_dict, stdout_xml
-from pyvcloud.vcd.client import QueryResultFormat
-from pyvcloud.vcd.client import ResourceType
-
-from cloudinventario.helpers import CloudCollector
+from cloudinventario.helpers import CloudCollector, lazy_import
+
+vcd = lazy_import("pyvcloud.vcd.client")
+vcdOrg = lazy_import("pyvcloud.vcd.org", "Org")
+vcdVDC = lazy_import("pyvcloud.vcd.vdc", "VDC")
+vcdVApp = lazy_import("pyvcloud.vcd.vapp", "VApp")
+vcdVM = lazy_import("pyvcloud.vcd.vapp", "VM")
+to_dict = lazy_import("pyvcloud.vcd.utils", "to_dict")
+vm_to_dict = lazy_import("pyvcloud.vcd.utils", "vm_to_dict")
+QueryResultFormat = lazy_import("pyvcloud.vcd.client", "QueryResultFormat")
+ResourceType = lazy_import("pyvcloud.vcd.client", "ResourceType")
 
 # TEST MODE
 TEST = 0
@@ -3,10 +3,12 @@ import sys, logging, re
 from pprint import pprint
 
 import ssl
-from pyVim.connect import SmartConnect, Disconnect
-from pyVmomi import vim
 
-from cloudinventario.helpers import CloudCollector
+from cloudinventario.helpers import CloudCollector, bounded_map, lazy_import
+
+SmartConnect = lazy_import("pyVim.connect", "SmartConnect")
+Disconnect = lazy_import("pyVim.connect", "Disconnect")
+vim = lazy_import("pyVmomi", "vim")
 
 # TEST mode enabled (limits number of fetched items)
 TEST = 0
@@ -51,8 +53,6 @@ class CloudCollectorVMWareVSphere(CloudCollector):
     return True
 
   def _fetch(self, collect):
-    res = []
-
     self.content = self.client.RetrieveContent()
 
     # collect networks (DistributedVirtualPortgroup)
@@ -122,7 +122,7 @@ class CloudCollectorVMWareVSphere(CloudCollector):
           if isinstance(cluster, vim.ComputeResource):
             recs = self.__process_cluster(cluster)
             if recs:
-              res.extend(recs)
+              yield from recs
             if TEST:
               break
           else:
@@ -136,17 +136,12 @@ class CloudCollectorVMWareVSphere(CloudCollector):
       if hasattr(child, 'vmFolder'):
         datacenter = child
         vmFolder = datacenter.vmFolder
-        with concurrent.futures.ThreadPoolExecutor(max_workers = self.options["tasks"] or 1) as executor:
-          futures = []
-          for vm in vmFolder.childEntity:
-            futures.append(executor.submit(self.__process_vmchild, vm))
-
-          for future in concurrent.futures.as_completed(futures):
-            recs = future.result()
+        tasks = self.options["tasks"] or 1
+        with concurrent.futures.ThreadPoolExecutor(max_workers = tasks) as executor:
+          # children are processed at most tasks * 2 ahead of the consumer (slow storage), records are not retained
+          for recs in bounded_map(executor, self.__process_vmchild, vmFolder.childEntity, tasks * 2):
             if recs:
-              res.extend(recs)
-
-    return res
+              yield from recs
 
   def __process_cluster(self, cluster):
     name = cluster.name
@@ -0,0 +1,215 @@
+"""Tags of S3 buckets and ELBs from a stubbed Resource Groups Tagging API."""
+import os, sys, unittest
+from unittest import mock
+
+DN = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(DN + '/../src')
+import cloudinventario_amazon_aws.collector as aws
+import cloudinventario_amazon_aws_multi.collector as aws_multi
+from cloudinventario_amazon_aws.tags import TagProvider, RESOURCE_TYPES
+from cloudinventario_amazon_aws.resources import s3, elb
+
+ACCOUNT = "123456789012"
+REGION = "eu-central-1"
+
+class TaggingPaginator:
+
+  def __init__(self, client):
+    self.client = client
+
+  def paginate(self, ResourceTypeFilters, ResourcesPerPage):
+    self.client.filters.append(ResourceTypeFilters)
+    resources = [res for res in self.client.resources
+                   if any(res["ResourceARN"].split(":")[2] == rtype.split(":")[0] and
+                            (":" not in rtype or res["ResourceARN"].split(":")[5].startswith(rtype.split(":")[1] + "/"))
+                          for rtype in ResourceTypeFilters)]
+    for idx in range(0, len(resources), ResourcesPerPage):
+      self.client.pages += 1
+      yield { "ResourceTagMappingList": resources[idx:idx + ResourcesPerPage] }
+
+class TaggingClient:
+
+  def __init__(self, resources):
+    self.resources = resources
+    self.filters = []
+    self.pages = 0
+
+  def get_paginator(self, name):
+    assert name == "get_resources"
+    return TaggingPaginator(self)
+
+class DeniedTaggingClient(TaggingClient):
+
+  def get_paginator(self, name):
+    self.pages += 1
+    raise Exception("AccessDenied: tag:GetResources")
+
+class ServiceClient:
+  """s3/elb client, tags must come from the provider."""
+
+  def list_buckets(self):
+    return { "Buckets": [{ "Name": "bucket-{}".format(idx) } for idx in range(3)] }
+
+  def get_bucket_location(self, Bucket):
+    return { "LocationConstraint": REGION }
+
+  def get_bucket_tagging(self, Bucket):
+    raise AssertionError("per bucket tagging call")
+
+  def describe_tags(self, LoadBalancerNames):
+    raise AssertionError("per balancer tagging call")
+
+  def describe_instance_health(self, LoadBalancerName):
+    return { "InstanceStates": [] }
+
+class TaggingServiceClient(ServiceClient):
+  """s3/elb client with the per resource tagging calls."""
+
+  def get_bucket_tagging(self, Bucket):
+    return { "TagSet": tag("bucket", Bucket) }
+
+  def describe_tags(self, LoadBalancerNames):
+    return { "TagDescriptions": [{ "LoadBalancerName": name, "Tags": tag("lb", name) } for name in LoadBalancerNames] }
+
+class Session:
+
+  def __init__(self, tagging, service_client = ServiceClient):
+    self.tagging = tagging
+    self.service_client = service_client
+    self.created = []
+
+  def client(self, service, region_name = None):
+    self.created.append((service, region_name))
+    if service == "resourcegroupstaggingapi":
+      return self.tagging
+    return self.service_client()
+
+def tag(key, value):
+  return [{ "Key": key, "Value": value }]
+
+RESOURCES = [
+  { "ResourceARN": "arn:aws:s3:::bucket-0", "Tags": tag("team", "a") },
+  { "ResourceARN": "arn:aws:s3:::bucket-2", "Tags": tag("team", "c") },
+  { "ResourceARN": "arn:aws:elasticloadbalancing:{}:{}:loadbalancer/lb-1".format(REGION, ACCOUNT), "Tags": tag("env", "prod") },
+  { "ResourceARN": "arn:aws:elasticloadbalancing:{}:{}:targetgroup/tg-1/0123".format(REGION, ACCOUNT), "Tags": tag("env", "tg") },
+  { "ResourceARN": "arn:aws:ec2:{}:{}:instance/i-1".format(REGION, ACCOUNT), "Tags": tag("env", "vm") }
+]
+
+def collector(tagging, config = None, service_client = ServiceClient):
+  col = aws.setup("aws", dict({ "tag_provider": True, "s3_calls": ["location", "tags"] }, **(config or {})), {}, {})
+  # state of _login() without STS/EC2
+  col.session = Session(tagging, service_client)
+  col.region = REGION
+  col.account_id = ACCOUNT
+  col.partition = "aws"
+  col.tag_provider = col.config["tag_provider"]
+  return col
+
+class TestTagProvider(unittest.TestCase):
+
+  def test_load_filters_types(self):
+    client = TaggingClient(RESOURCES)
+    provider = TagProvider(client)
+    self.assertEqual(provider.get("arn:aws:s3:::bucket-0"), tag("team", "a"))
+    self.assertEqual(provider.get("arn:aws:ec2:{}:{}:instance/i-1".format(REGION, ACCOUNT)), None)
+    self.assertEqual(provider.get("arn:aws:s3:::bucket-1", []), [])
+    # loaded once
+    self.assertEqual(client.filters, [RESOURCE_TYPES])
+    self.assertEqual(set(provider.tags.keys()), set(res["ResourceARN"] for res in RESOURCES[:3]))
+
+  def test_pages(self):
+    client = TaggingClient([{ "ResourceARN": "arn:aws:s3:::bucket-{}".format(idx), "Tags": [] } for idx in range(250)])
+    provider = TagProvider(client, ["s3"])
+    self.assertEqual(provider.get("arn:aws:s3:::bucket-249"), [])
+    self.assertEqual(client.pages, 3)
+
+  def test_arn(self):
+    col = collector(TaggingClient([]))
+    self.assertEqual(col.get_arn("s3", "bucket-0"), "arn:aws:s3:::bucket-0")
+    self.assertEqual(col.get_arn("elasticloadbalancing", "loadbalancer/lb-1", REGION, ACCOUNT),
+                     "arn:aws:elasticloadbalancing:{}:{}:loadbalancer/lb-1".format(REGION, ACCOUNT))
+
+  def test_disabled(self):
+    col = collector(TaggingClient(RESOURCES), { "tag_provider": False })
+    self.assertIsNone(col.get_tag_provider())
+
+  def test_s3(self):
+    tagging = TaggingClient(RESOURCES)
+    col = collector(tagging)
+    res = s3.setup("s3", col)
+    res.login(col.session)
+    res.fetch()
+    self.assertEqual([bucket["tags"] for bucket in res.raw_data], [{ "team": "a" }, None, { "team": "c" }])
+    # one provider (client) per region, shared with the other resources
+    self.assertEqual(col.session.created.count(("resourcegroupstaggingapi", REGION)), 1)
+    self.assertEqual(tagging.filters, [RESOURCE_TYPES])
+
+  def test_elb(self):
+    col = collector(TaggingClient(RESOURCES))
+    res = elb.setup("elb", col)
+    res.login(col.session)
+    for name, tags in [("lb-1", tag("env", "prod")), ("lb-2", [])]:
+      balancer = { "LoadBalancerName": name, "CreatedTime": None, "AvailabilityZones": [],
+                   "CanonicalHostedZoneNameID": "Z1", "CanonicalHostedZoneName": name + ".example.com",
+                   "Scheme": "internet-facing", "Subnets": [] }
+      res._process_resource(balancer)
+      self.assertEqual(balancer["TagDescriptions"], [{ "LoadBalancerName": name, "Tags": tags }])
+
+  def test_denied(self):
+    tagging = DeniedTaggingClient([])
+    provider = TagProvider(tagging)
+    self.assertFalse(provider.available())
+    self.assertEqual(provider.get("arn:aws:s3:::bucket-0", []), [])
+    # failure is not retried
+    self.assertEqual(tagging.pages, 1)
+
+  def test_denied_fallback(self):
+    tagging = DeniedTaggingClient([])
+    col = collector(tagging, service_client = TaggingServiceClient)
+    res = s3.setup("s3", col)
+    res.login(col.session)
+    res.fetch()
+    self.assertEqual([bucket["tags"] for bucket in res.raw_data], [{ "bucket": "bucket-{}".format(idx) } for idx in range(3)])
+
+    res = elb.setup("elb", col)
+    res.login(col.session)
+    balancer = { "LoadBalancerName": "lb-1", "CreatedTime": None, "AvailabilityZones": [],
+                 "CanonicalHostedZoneNameID": "Z1", "CanonicalHostedZoneName": "lb-1.example.com",
+                 "Scheme": "internet-facing", "Subnets": [] }
+    res._process_resource(balancer)
+    self.assertEqual(balancer["TagDescriptions"], [{ "LoadBalancerName": "lb-1", "Tags": tag("lb", "lb-1") }])
+    self.assertEqual(tagging.pages, 1)
+
+class TestMultiHandleConfig(unittest.TestCase):
+
+  def test_handle_config(self):
+    config = { "access_key": "a", "secret_key": "s", "region": REGION, "regions": [REGION],
+               "roles": [{ "account": ACCOUNT, "role": "inventory" }],
+               "tag_provider": True, "s3_workers": 4, "s3_calls": ["tags"], "instance_types_ttl": 60 }
+    col = aws_multi.setup("multi", config, {}, {})
+    handles = []
+
+    sts = mock.Mock()
+    sts.assume_role.return_value = { "Credentials": { "AccessKeyId": "ak", "SecretAccessKey": "sk", "SessionToken": "st" } }
+    boto3 = mock.Mock()
+    boto3.session.Session.return_value.client.return_value = sts
+
+    def load(module, name, config, defaults, options):
+      handle = mock.Mock()
+      handle.config = config
+      handles.append(handle)
+      return handle
+
+    with mock.patch.object(aws_multi.CloudInventario, "loadCollectorModule", side_effect = load), \
+         mock.patch.object(aws_multi, "boto3", boto3):
+      col._login()
+
+    self.assertEqual(len(handles), 1)
+    self.assertEqual(handles[0].config["region"], REGION)
+    self.assertEqual(handles[0].config["access_key"], "ak")
+    for key in ["tag_provider", "s3_workers", "s3_calls", "instance_types_ttl"]:
+      self.assertEqual(handles[0].config[key], config[key])
+    self.assertNotIn("regions", handles[0].config)
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,38 @@
+"""Projection of details by include/exclude paths."""
+import os, sys, unittest
+
+DN = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(DN + '/../src')
+from cloudinventario.projection import Projection
+
+DETAILS = {
+  "name": "vm-1",
+  "meta": { "a": 1, "b": 2 },
+  "disks": [{ "size": 10, "licenses": ["l1"], "extra": { "size": 1 } }, { "size": 20 }],
+  "nested": [[{ "x": 1, "y": 2 }]]
+}
+
+class TestProjection(unittest.TestCase):
+
+  def test_include_list_items(self):
+    self.assertEqual(Projection(["disks.*.size"]).apply(DETAILS), { "disks": [{ "size": 10 }, { "size": 20 }] })
+    self.assertEqual(Projection(["disks.size"]).apply(DETAILS), { "disks": [{ "size": 10 }, { "size": 20 }] })
+    self.assertEqual(Projection(["nested.*.*.x"]).apply(DETAILS), { "nested": [[{ "x": 1 }]] })
+
+  def test_star_is_not_a_key_of_items(self):
+    # disks.*.size is not disks[i].<key>.size
+    self.assertEqual(Projection(["disks.*.size"]).apply(DETAILS)["disks"][0], { "size": 10 })
+
+  def test_exclude_list_items(self):
+    self.assertEqual(Projection(exclude = ["disks.*"]).apply(DETAILS)["disks"], [])
+    self.assertEqual(Projection(exclude = ["meta.*"]).apply(DETAILS)["meta"], {})
+    self.assertEqual(Projection(exclude = ["disks.*.licenses"]).apply(DETAILS)["disks"],
+                     [{ "size": 10, "extra": { "size": 1 } }, { "size": 20 }])
+    self.assertNotIn("disks", Projection(exclude = ["disks"]).apply(DETAILS))
+
+  def test_input_unchanged(self):
+    Projection(["name"], ["disks.*"]).apply(DETAILS)
+    self.assertEqual(len(DETAILS["disks"]), 2)
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,102 @@
+"""InventoryStorage on a scratch SQLite database."""
+import os, sys, sqlite3, tempfile, unittest
+
+DN = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(DN + '/../src')
+from cloudinventario.storage import InventoryStorage
+from cloudinventario.record import InventoryRecord
+
+class StorageTestCase(unittest.TestCase):
+
+  def setUp(self):
+    self.tmp = tempfile.TemporaryDirectory()
+    self.path = os.path.join(self.tmp.name, "inventory.db")
+
+  def tearDown(self):
+    self.storage.close()
+    self.tmp.cleanup()
+
+  def connect(self, **config):
+    self.storage = InventoryStorage(dict({ "dsn": "sqlite:///" + self.path }, **config))
+    self.storage.connect()
+    return self.storage
+
+  def query(self, sql):
+    with sqlite3.connect(self.path) as conn:
+      return conn.execute(sql).fetchall()
+
+def records(sources, count, cpus, fail = None):
+  # sources interleaved, as aws-multi produces them
+  for idx in range(count):
+    for source in sources:
+      if idx == fail:
+        raise Exception("collector failed")
+      yield InventoryRecord(source = source, type = "vm", name = "vm-{}".format(idx), id = "i-{}".format(idx),
+                            cpus = cpus if idx % 2 else 1)
+
+class TestEntityLayout(StorageTestCase):
+
+  def snapshot(self):
+    return (self.query("SELECT source, entity_key, hash, version_first, version_changed, version_last, last_seen, changed_at, cpus"
+                       " FROM ci_entity ORDER BY source, entity_key"),
+            self.query("SELECT source, entity_id, version_from, version_to, valid_to, cpus"
+                       " FROM ci_entity_history ORDER BY source, entity_id, version_from"))
+
+  def test_rollback_multi_source(self):
+    storage = self.connect(layout = "entity", batch_size = 4)
+    sources = ["m@1", "m@2"]
+    storage.save(records(sources, 6, 1))
+    storage.save(records(sources, 6, 2))
+    before = self.snapshot()
+    self.assertEqual(len(before[1]), 6)
+
+    with self.assertRaises(Exception):
+      storage.save(records(sources, 10, 3, fail = 8))
+    self.assertEqual(self.snapshot(), before)
+
+    # history rows end at the seen time of their own source
+    storage.save(records(sources, 6, 3))
+    for source in sources:
+      last_seen = self.query("SELECT DISTINCT last_seen FROM ci_entity WHERE source = '{}'".format(source))
+      valid_to = self.query("SELECT DISTINCT valid_to FROM ci_entity_history WHERE source = '{}' AND version_to = 2".format(source))
+      self.assertEqual(valid_to, last_seen)
+    self.assertEqual([rec["cpus"] for rec in storage.load("m@1")], [1, 3, 1, 3, 1, 3])
+
+class TestDelta(StorageTestCase):
+
+  def test_integer_ids(self):
+    storage = self.connect(delta = True, batch_size = 2)
+    data = lambda: [InventoryRecord(source = "hcloud", type = "vm", name = "vm-{}".format(idx), id = idx, cpus = 2)
+                      for idx in range(5)] + [InventoryRecord(source = "hcloud", type = "lb", name = "lb", id = None, cpus = 1)]
+    for run in range(3):
+      storage.save(data())
+    self.assertEqual(self.query("SELECT version, version_last, COUNT(*) FROM ci_inventory GROUP BY version, version_last"),
+                     [(1, 3, 6)])
+    self.assertEqual(len(list(storage.load("hcloud", 3))), 6)
+
+class TestCleanup(StorageTestCase):
+
+  def test_keep_skips_running_version(self):
+    storage = self.connect(batch_size = 2)
+    storage.save(records(["s"], 4, 1))
+
+    def running():
+      for idx, rec in enumerate(records(["s"], 6, 2)):
+        if idx == 4:
+          # batches of the running version are stored already
+          storage.cleanup(keep = 0)
+        yield rec
+    storage.save(running())
+
+    self.assertEqual(self.query("SELECT version, COUNT(*) FROM ci_inventory GROUP BY version"), [(2, 6)])
+    self.assertEqual(self.query("SELECT version, status FROM ci_source"), [(2, "OK")])
+
+  def test_keep_sources(self):
+    storage = self.connect()
+    for source in ["a", "b"]:
+      storage.save(records([source], 2, 1))
+    storage.cleanup(keep = 0, sources = ["a"])
+    self.assertEqual(self.query("SELECT source, COUNT(*) FROM ci_inventory GROUP BY source"), [("b", 2)])
+
+if __name__ == '__main__':
+  unittest.main()